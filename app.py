@@ -3,12 +3,22 @@ from gevent import monkey
 
 monkey.patch_all()
 
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, Response, render_template, request, redirect, url_for
+from gevent import sleep, spawn
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from steam.enums import EResult
 from client import LocalSteamClient
-from db import init_app, get_db, query_builder
+from progress import download_states
+from cdn_pool import server_pool
+import metrics
+from db import init_app, get_db
 from pathlib import Path
 from utils import human_readable
+import json
+import re
+import subprocess
+import sys
+import time
 
 from timelimits import TimeRange
 
@@ -18,11 +28,84 @@ app.config.from_mapping(DATABASE="./steamer.db")
 init_app(app)  # Setup the db connection for Flask
 steam = LocalSteamClient()
 
+# Seconds between keepalive comments on an idle progress stream, and the least time between two updates
+STREAM_KEEPALIVE = 15
+STREAM_MIN_INTERVAL = 0.5
+
+# Verify runs started from the web side, by app id
+verify_runs = {}
+
+# Apps per page of the library, and the most a client can ask for at once
+APPS_PAGE_SIZE = 60
+APPS_PAGE_MAX = 500
+
+
+def encode_cursor(name, app_id):
+    """
+    Function used for turning the last row of a page into an opaque cursor for the next one.
+    """
+    return urlsafe_b64encode(json.dumps([name, app_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Function used for reading a cursor made by `encode_cursor`. Returns `(name, app_id)`, or None for a bad cursor.
+    """
+    try:
+        name, app_id = json.loads(urlsafe_b64decode(cursor.encode()))
+        return str(name), int(app_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def query_apps(db, q="", cursor=None, limit=APPS_PAGE_SIZE):
+    """
+    Function used for reading one page of the library, ordered by name.
+
+    Pages are keyset paginated on `(name, app_id)`, so every page is a short walk of the `apps_by_name` index
+    no matter how deep into the library it is. `q` is matched against app names as word prefixes using the
+    `apps_fts` index.
+
+    Returns: `(rows, next_cursor)`, where next_cursor is None on the last page.
+    """
+    query = "select app_id, name, logo from apps where name not like '%Server%' and logo != ''"
+    args = []
+
+    words = re.findall(r"\w+", q or "")
+    if words:
+        has_fts = db.execute(
+            "select 1 from sqlite_master where type='table' and name='apps_fts'"
+        ).fetchone()
+        if has_fts:
+            query += " and app_id in (select rowid from apps_fts where apps_fts match ?)"
+            args.append(" ".join('"{}"*'.format(w) for w in words))
+        else:
+            for w in words:
+                query += " and name like ?"
+                args.append("%{}%".format(w))
+
+    if cursor is not None:
+        query += " and (name > ? or (name = ? and app_id > ?))"
+        args += [cursor[0], cursor[0], cursor[1]]
+
+    # One extra row tells us whether there is a next page
+    query += " order by name, app_id limit ?"
+    args.append(limit + 1)
+
+    rows = db.execute(query, args).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["name"], rows[-1]["app_id"])
+
+    return rows, next_cursor
+
 
 @app.route("/")
 def main_page():
     """
-    App route for rendering `home.html`. Touches the database for app information and the username.
+    App route for rendering `home.html`. Touches the database for the first page of apps and the username;
+    the rest of the library is loaded by the page through `/api/v1/apps`.
 
     Redirects: Redirects to login page if the user is not logged in.
     """
@@ -31,11 +114,11 @@ def main_page():
         # return "Please run the setup.py file. Steam can't work without it!"
 
     db = get_db()
-    apps = db.execute(
-        "select * from apps where name not like '%Server%' and logo not like '' order by name ASC"
-    ).fetchall()
+    apps, next_cursor = query_apps(db)
     username = steam.username
-    return render_template("home.html", apps=apps, username=username)
+    return render_template(
+        "home.html", apps=apps, next_cursor=next_cursor, username=username
+    )
 
 
 @app.route("/settings")
@@ -63,42 +146,33 @@ def app_page(app_id):
     Inputs: app_id: Integer ID for a steam app.
 
     Note: This function also preforms calls to `human_readable(bytes)` to calculate the space needed by each depot.
+    The total comes precomputed from `app_sizes`.
     """
     db = get_db()
 
     # depot_info = db.execute("select * from depots where app_id=? and is_dlc=0 and name not like '%Linux' and name not like '%Mac%'", (app_id,)).fetchall()
-    depot_ids = [app_id] + steam.get_filtered_depots_for_app(app_id)
+    total_size, downloadable = steam.get_app_size(app_id)
 
     # Change the behavior for the case where no depots can be selected.
-    unable_to_download = False
-    if len(depot_ids) == 1:
-        query_string = "select * from depots where app_id=? collate nocase"
-        unable_to_download = True
-
-    else:
-        query_string = query_builder(
-            "select * from depots where app_id=? and depot_id in (?",
-            ",?",
-            len(depot_ids) - 2,
-            ") collate nocase",
-        )
-
-    depot_info = db.execute(query_string, depot_ids)
+    unable_to_download = not downloadable
+    query_string = "select * from depots d where d.app_id=?"
+    query_vals = [app_id]
+    if downloadable:
+        clause, filter_vals = steam.depot_filter_clause()
+        query_string += clause
+        query_vals += filter_vals
+
+    depot_info = db.execute(query_string, query_vals)
     app_name = db.execute("select name from apps where app_id=?", (app_id,)).fetchone()
 
     d_out = []
-    total_size = 0
     for d in depot_info:
         depot_id, _, name, size, _, _, _ = d
-        total_size += size
         size = human_readable(size)
         d_out.append((name, depot_id, size))
 
     # Check if the game is already queued for download.
-    queued = False
-    for proc in steam.process_list:
-        if proc[1] == app_id:
-            queued = True
+    queued = steam.scheduler.is_queued(app_id)
 
     return render_template(
         "app.html",
@@ -118,9 +192,23 @@ def schedule_download(app_id):
     Input:
     - Integer app_id -> app being targeted for download
     - JSON TimeRange -> time range app can be downloaded during.
+
+    Returns 409 if the app is already queued or being verified.
     """
+    if verify_runs.get(int(app_id), {}).get("running"):
+        return {"response": "App is being verified."}, 409
+
+    # A second process for the same app would write the same files and journal rows
+    if steam.scheduler.is_queued(app_id):
+        return {
+            "response": "App is already queued; change its priority through /api/v1/queue/<app_id>."
+        }, 409
+
     # Get the JSON request from the website
-    j = request.get_json()
+    j = request.get_json(silent=True) or {}
+    if not all(key in j for key in ("start_hour", "start_min", "end_hour", "end_min")):
+        return {"response": "Expected start_hour, start_min, end_hour and end_min."}, 400
+
     tr = TimeRange(
         int(j["start_hour"]),
         int(j["start_min"]),
@@ -128,7 +216,7 @@ def schedule_download(app_id):
         int(j["end_min"]),
     )
 
-    steam.download_app(app_id, tr)
+    steam.download_app(app_id, tr, priority=int(j.get("priority", 0)))
 
     # Parse the time
     return "Okay!"
@@ -211,6 +299,75 @@ def update_app():
     return {"done": True}
 
 
+@app.route("/api/v1/apps")
+def api_get_apps():
+    """
+    API route for paging through the library.
+
+    Input:
+    - str q -> Optional search, matched against the start of words in app names.
+    - str cursor -> Optional cursor from a previous page.
+    - int limit -> Optional page size.
+
+    Returns:
+    - JSON -> data holds the apps, next_cursor is null on the last page
+    """
+    cursor = None
+    if request.args.get("cursor"):
+        cursor = decode_cursor(request.args["cursor"])
+        if cursor is None:
+            return {"response": "Bad cursor."}, 400
+
+    limit = max(1, min(request.args.get("limit", APPS_PAGE_SIZE, type=int), APPS_PAGE_MAX))
+
+    rows, next_cursor = query_apps(
+        get_db(), request.args.get("q", ""), cursor=cursor, limit=limit
+    )
+    return {
+        "data": [
+            {"app_id": r["app_id"], "name": r["name"], "logo": r["logo"]} for r in rows
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+@app.route("/api/v1/apps/largest")
+def api_get_largest_apps():
+    """
+    API route for the biggest downloads in the library under the current os/language settings.
+
+    Input:
+    - int limit -> Optional number of apps to return.
+
+    Returns:
+    - JSON -> data holds app_id, name, size in bytes and a readable size, biggest first
+    """
+    limit = max(1, min(request.args.get("limit", 20, type=int), APPS_PAGE_MAX))
+
+    return {
+        "data": [
+            {
+                "app_id": app_id,
+                "name": name,
+                "size": size,
+                "size_readable": human_readable(size),
+            }
+            for app_id, name, size in steam.get_largest_apps(limit)
+        ]
+    }
+
+
+@app.route("/api/v1/populate/progress")
+def api_populate_progress():
+    """
+    API route for following a running populate.
+
+    Returns:
+    - JSON -> bool:running, plus app and batch counts once the populate knows how much there is to do.
+    """
+    return steam.sync_progress
+
+
 @app.route("/api/v1/settings")
 def api_get_settings():
     """
@@ -242,12 +399,203 @@ def api_update_settings():
 @app.route("/api/v1/query_downloads")
 def api_query_downloads():
     """
-    API route for finding what items are in the download queue.
+    API route for finding what items are in the download queue, and how far along they are.
 
     Returns:
-    - JSON -> data contains the information
+    - JSON -> data contains the information: per app bytes done/total (also per depot), chunks_per_second,
+      bytes_per_second (moving average), eta_seconds, and idle_seconds since the last chunk landed
     """
     s = steam.check_download_state_all()
-    print(s)
 
     return {"data": s}
+
+
+@app.route("/api/v1/downloads/stream")
+def api_stream_downloads():
+    """
+    API route streaming the state of the download queue as Server-Sent Events.
+
+    Every update is a `downloads` event whose data is the same JSON list `/api/v1/query_downloads` returns.
+    The stream only reads `download_states`, so listeners never hold up the downloads.
+    """
+
+    def stream():
+        yield "retry: 3000\n\n"
+
+        version = -1
+        while True:
+            if download_states.version != version:
+                version = download_states.version
+                yield "event: downloads\ndata: {}\n\n".format(
+                    json.dumps(download_states.snapshot())
+                )
+                # Let a burst of updates pile up into the next event
+                sleep(STREAM_MIN_INTERVAL)
+
+            elif download_states.wait(version, STREAM_KEEPALIVE) == version:
+                # Keeps proxies from closing the connection, and notices when the browser went away
+                yield ": keepalive\n\n"
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def run_verify(app_id: int, time_range, repair=True):
+    """
+    Function used for checking an installed app in the background.
+
+    The check runs as `client.py verify` in its own process, so the hashing process pool never has to share
+    the gevent loop with the server. The verify records good chunks in the chunk journals; if anything is bad
+    and `repair` is set, the app is queued for download, which then only fetches the bad chunks.
+    """
+    verify_runs[app_id] = {"running": True, "started": time.time()}
+
+    result = subprocess.run(
+        [sys.executable, "client.py", "verify", str(app_id), "--json"],
+        cwd=str(Path(__file__).resolve().parent),
+        capture_output=True,
+        text=True,
+    )
+
+    run = {"running": False, "started": verify_runs[app_id]["started"], "finished": time.time()}
+    try:
+        run["report"] = json.loads(result.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        run["error"] = result.stderr.strip().splitlines()[-5:]
+        verify_runs[app_id] = run
+        return
+
+    if run["report"]["error"]:
+        run["error"] = run["report"]["error"]
+        verify_runs[app_id] = run
+        return
+
+    if repair and run["report"]["bad"] and not steam.scheduler.is_queued(app_id):
+        steam.download_app(app_id, time_range)
+        run["repair_queued"] = True
+
+    verify_runs[app_id] = run
+
+
+@app.route("/api/v1/verify/<int:app_id>", methods=["GET", "POST"])
+def api_verify_app(app_id):
+    """
+    API route for checking an installed app against the manifests it was downloaded with.
+
+    POST starts a check, with optional JSON bool:repair (default true) and the same time range fields as a
+    download for the repair. GET returns the state of the last check: bool:running, and once it is done the
+    report, with the list of bad chunks, or an error if nothing was recorded as installed.
+
+    A check can't start while the app is queued, and the app can't be queued while it is being checked: the
+    check writes the same chunk journal a download does.
+    """
+    if request.method == "POST":
+        if verify_runs.get(app_id, {}).get("running"):
+            return {"response": "Already verifying."}, 409
+
+        if steam.scheduler.is_queued(app_id):
+            return {"response": "App is queued for download; remove it from the queue first."}, 409
+
+        j = request.get_json(silent=True) or {}
+        tr = TimeRange(
+            int(j.get("start_hour", 0)),
+            int(j.get("start_min", 0)),
+            int(j.get("end_hour", 23)),
+            int(j.get("end_min", 59)),
+        )
+        verify_runs[app_id] = {"running": True, "started": time.time()}
+        spawn(run_verify, app_id, tr, bool(j.get("repair", True)))
+
+    if app_id not in verify_runs:
+        return {"response": "This app was not verified."}, 404
+
+    return verify_runs[app_id]
+
+
+@app.route("/api/v1/cdn/servers")
+def api_cdn_servers():
+    """
+    API route for seeing how the content servers are doing.
+
+    Returns:
+    - JSON -> data is a list of servers, best first, with their rolling latency_seconds and bytes_per_second,
+      requests in flight, totals, and ejected_seconds left for servers taken out of the pool
+    """
+    return {"data": server_pool.state()}
+
+
+@app.route("/api/v1/metrics")
+def api_metrics():
+    """
+    API route exposing the download timings (cdn fetch, decode, verify, write, copy, command handling) and
+    counters in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/v1/profile/<app_id>", methods=["GET", "POST"])
+def api_profile_download(app_id):
+    """
+    API route for the sampling profiler of a queued download.
+
+    GET returns the stacks sampled so far in the folded format flame graph tools read.
+    POST with JSON bool:enabled turns the profiler on or off, returning what was sampled until then.
+    """
+    job = steam.scheduler.find(app_id)
+    if job is None:
+        return {"response": "App is not queued."}, 404
+
+    if request.method == "POST":
+        j = request.get_json(silent=True) or {}
+        if "enabled" not in j:
+            return {"response": "Expected bool:enabled."}, 400
+
+        folded = job.proc.set_profiling(bool(j["enabled"]))
+    else:
+        folded = metrics.profiler.folded(job.proc)
+
+    return Response(folded, mimetype="text/plain")
+
+
+@app.route("/api/v1/queue")
+def api_get_queue():
+    """
+    API route for looking at the download queue, in the order apps get a download slot.
+
+    Returns:
+    - JSON -> data contains the information
+    """
+    return {"data": steam.scheduler.state()}
+
+
+@app.route("/api/v1/queue/<app_id>", methods=["POST"])
+def api_update_queue(app_id):
+    """
+    API route for reordering the download queue.
+
+    **POST ONLY**
+
+    Input:
+    - JSON -> Optional int:priority, optional int:position (among apps of the same priority),
+      optional bool:remove to take the app out of the queue.
+    """
+    j = request.get_json(silent=True) or {}
+    if not any(key in j for key in ("remove", "priority", "position")):
+        return {"response": "Expected one of remove, priority or position."}, 400
+
+    if j.get("remove", False):
+        found = steam.scheduler.remove(app_id)
+    else:
+        found = steam.scheduler.is_queued(app_id)
+        if "priority" in j:
+            steam.scheduler.set_priority(app_id, j["priority"])
+        if "position" in j:
+            steam.scheduler.move(app_id, j["position"])
+
+    if not found:
+        return {"response": "App is not queued."}, 404
+
+    return {"data": steam.scheduler.state()}
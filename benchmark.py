@@ -0,0 +1,331 @@
+"""
+Offline benchmark for the download engine.
+
+Runs `ManifestProcess.handle_manifest` against a local stand-in for the Steam cdn that serves synthetic depots, so
+no login is needed. Three scenarios are timed, each in a scratch directory and database:
+
+- fresh: nothing on disk.
+- resume: a fraction of the depot was downloaded before the previous run was stopped.
+- update: the full previous version is installed and a new version with some changed files is applied.
+
+For each one it prints chunks/s, MB/s, CPU time, peak RSS and the read/write syscalls from /proc/self/io:
+
+    python benchmark.py --files 64 --chunks-per-file 4 --chunk-size 262144 --latency 20
+"""
+import argparse
+import hashlib
+import random
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import gevent
+
+import db
+from dedup import ChunkIndex
+from delta import ManifestDiff
+from dl_handler import ManifestProcess
+from logs import setup_logging
+from steam.client.cdn import CDNDepotManifest
+from steam.core.manifest import DepotManifest
+
+BENCH_APP_ID = 1
+BENCH_DEPOT_ID = 2
+
+
+class FakeSteam:
+    """
+    Class standing in for the SteamClient the cdn client hangs off of.
+    """
+
+    logged_on = True
+
+
+class FakeCDN:
+    """
+    Class standing in for `CDNClient`. Chunks are served out of memory after an optional delay.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        """
+        Constructor method. `latency` and `jitter` are in seconds.
+        """
+        self.steam = FakeSteam()
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = {}
+        self.manifests = []
+        self.served = 0
+        self.served_bytes = 0
+        self.stop_after = None
+        self.proc = None
+
+    def get_chunk(self, app_id, depot_id, chunk_id):
+        """
+        Class method. Same as `CDNClient.get_chunk`.
+        """
+        if self.latency or self.jitter:
+            gevent.sleep(self.latency + random.random() * self.jitter)
+
+        data = self.chunks[bytes.fromhex(chunk_id)]
+        self.served += 1
+        self.served_bytes += len(data)
+
+        # Used to leave a partial download behind for the resume scenario
+        if self.stop_after is not None and self.served >= self.stop_after:
+            self.proc.downloading = False
+
+        return data
+
+    def get_manifests(self, app_id, branch="public", password=None, filter_func=None, decrypt=True):
+        """
+        Class method. Same as `CDNClient.get_manifests`, for the manifests in `self.manifests`.
+        """
+        return [
+            m for m in self.manifests if filter_func is None or filter_func(m.depot_id, {})
+        ]
+
+
+class SyntheticDepot:
+    """
+    Class building synthetic depot manifests whose chunks are registered with a `FakeCDN`.
+    """
+
+    def __init__(self, cdn, chunk_size: int, duplicates: float, seed: int = 0):
+        """
+        Constructor method. About `duplicates` of the chunks repeat a chunk used earlier in the depot.
+        """
+        self.cdn = cdn
+        self.chunk_size = chunk_size
+        self.duplicates = duplicates
+        self.random = random.Random(seed)
+        self.next_seed = seed
+
+    def new_chunk(self):
+        """
+        Class method. Makes a chunk of random data and returns its sha.
+        """
+        self.next_seed += 1
+        data = random.Random(self.next_seed).randbytes(self.chunk_size)
+        sha = hashlib.sha1(data).digest()
+        self.cdn.chunks[sha] = data
+        return sha
+
+    def pick_chunk(self, used):
+        """
+        Class method. Returns a repeated chunk from `used` now and then, otherwise a new one.
+        """
+        if used and self.random.random() < self.duplicates:
+            return self.random.choice(used)
+
+        sha = self.new_chunk()
+        used.append(sha)
+        return sha
+
+    def layout(self, files: int, chunks_per_file: int):
+        """
+        Class method. Returns `{filename: [sha, ...]}` for a new depot.
+        """
+        used = []
+        return {
+            "data/file{:05}.bin".format(i): [self.pick_chunk(used) for _ in range(chunks_per_file)]
+            for i in range(files)
+        }
+
+    def change(self, layout, changed: float):
+        """
+        Class method. Returns a copy of `layout` where about `changed` of the files got one new chunk, one file
+        is gone and one was added.
+        """
+        new = {name: list(shas) for name, shas in layout.items()}
+        for name, shas in new.items():
+            if self.random.random() < changed:
+                shas[self.random.randrange(len(shas))] = self.new_chunk()
+
+        names = sorted(new)
+        del new[names[0]]
+        new["data/added.bin"] = [self.new_chunk() for _ in layout[names[-1]]]
+        return new
+
+    def manifest(self, layout, gid: int):
+        """
+        Class method. Turns a layout into a `CDNDepotManifest`.
+        """
+        m = DepotManifest()
+        m.metadata.depot_id = BENCH_DEPOT_ID
+        m.metadata.gid_manifest = gid
+        m.metadata.filenames_encrypted = False
+
+        directory = m.payload.mappings.add()
+        directory.filename = "data"
+        directory.flags = 64  # EDepotFileFlag.Directory
+
+        for name, shas in sorted(layout.items()):
+            mapping = m.payload.mappings.add()
+            mapping.filename = name
+            mapping.size = len(shas) * self.chunk_size
+            for i, sha in enumerate(shas):
+                chunk = mapping.chunks.add()
+                chunk.sha = sha
+                chunk.offset = i * self.chunk_size
+                chunk.cb_original = self.chunk_size
+                chunk.cb_compressed = self.chunk_size
+
+        return CDNDepotManifest(self.cdn, BENCH_APP_ID, m.serialize(compress=False))
+
+
+def read_proc_io():
+    """
+    Function used for reading the I/O counters of this process. Returns an empty dictionary off Linux.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return {k: int(v) for k, v in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def run_manifest(cdn, download_path, manifest, diff=None, concurrency=8):
+    """
+    Function used for running `handle_manifest` the way `download_depots` would. Resets the cdn's served
+    counters first. Returns the process.
+    """
+    # Counted per run, so `stop_after` of a partial run counts from its own first chunk
+    cdn.served = 0
+    cdn.served_bytes = 0
+
+    proc = ManifestProcess(cdn, download_path, chunk_concurrency=concurrency)
+    proc.target_app = BENCH_APP_ID
+    proc.downloading = True
+    cdn.proc = proc
+
+    proc.chunk_index = ChunkIndex()
+    proc.chunk_index.add_manifest(manifest)
+    proc.progress.reset()
+    proc.progress.add_depot(manifest.depot_id, sum(f.size for f in manifest.iter_files()))
+
+    if proc.handle_manifest(manifest, diff=diff) and diff is not None:
+        proc.remove_files(
+            Path(download_path), diff.removed, {f.filename for f in manifest.iter_files()}
+        )
+
+    return proc
+
+
+def measure(name, cdn, download_path, manifest, diff=None, concurrency=8):
+    """
+    Function used for timing one `handle_manifest` run and printing a result row.
+    """
+    cdn.stop_after = None
+
+    io_before = read_proc_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+
+    proc = run_manifest(cdn, download_path, manifest, diff=diff, concurrency=concurrency)
+
+    wall = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = read_proc_io()
+
+    chunks = sum(len(f.chunks) for f in manifest.iter_files())
+    size = sum(f.size for f in manifest.iter_files())
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+
+    print(
+        "{:<8} {:>8.2f} {:>9.0f} {:>8.1f} {:>8} {:>8.2f} {:>9.1f} {:>9} {:>9} {:>7}".format(
+            name,
+            wall,
+            chunks / wall,
+            size / wall / 1e6,
+            cdn.served,
+            cpu,
+            usage.ru_maxrss / 1024.0,  # KiB on Linux
+            io_after.get("syscr", 0) - io_before.get("syscr", 0),
+            io_after.get("syscw", 0) - io_before.get("syscw", 0),
+            proc.chunk_failures,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--chunks-per-file", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=256 * 1024)
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Fraction of repeated chunks")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds per chunk request")
+    parser.add_argument("--jitter", type=float, default=0, help="Extra random milliseconds per request")
+    parser.add_argument("--concurrency", type=int, default=8, help="Chunk requests in flight")
+    parser.add_argument("--resume-at", type=float, default=0.5, help="Fraction fetched before the resume")
+    parser.add_argument("--changed", type=float, default=0.2, help="Fraction of files changed by the update")
+    parser.add_argument("--scenarios", default="fresh,resume,update")
+    parser.add_argument("--log-level", default="info", help="info or debug")
+    parser.add_argument("--keep", action="store_true", help="Leave the scratch directory behind")
+    args = parser.parse_args()
+
+    scratch = Path(tempfile.mkdtemp(prefix="steamer-bench-"))
+    # Keep the journal and installed manifests out of the real steamer.db
+    db.pool = db.ConnectionPool(str(scratch / "bench.db"))
+    # Log like the server does, so the cost of logging is part of the numbers
+    setup_logging(str(scratch / "bench.log"), level=args.log_level)
+
+    cdn = FakeCDN(args.latency / 1000.0, args.jitter / 1000.0)
+    depot = SyntheticDepot(cdn, args.chunk_size, args.duplicates)
+    layout = depot.layout(args.files, args.chunks_per_file)
+    manifest = depot.manifest(layout, gid=1000)
+    cdn.manifests = [manifest]
+
+    print(
+        "{} files, {} chunks of {} bytes, {:.0%} repeated, {} ms latency, {} in flight".format(
+            args.files,
+            args.files * args.chunks_per_file,
+            args.chunk_size,
+            args.duplicates,
+            args.latency,
+            args.concurrency,
+        )
+    )
+    print(
+        "{:<8} {:>8} {:>9} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>7}".format(
+            "scenario", "wall s", "chunks/s", "MB/s", "fetched", "cpu s", "rss MiB", "read sc", "write sc", "failed"
+        )
+    )
+
+    try:
+        scenarios = args.scenarios.split(",")
+        if "fresh" in scenarios:
+            measure("fresh", cdn, scratch / "fresh", manifest, concurrency=args.concurrency)
+
+        if "resume" in scenarios:
+            # Stop a first run part of the way through, then time picking it back up
+            partial = scratch / "resume"
+            cdn.stop_after = max(1, int(len(cdn.chunks) * args.resume_at))
+            run_manifest(cdn, partial, manifest, concurrency=args.concurrency)
+
+            measure("resume", cdn, partial, manifest, concurrency=args.concurrency)
+
+        if "update" in scenarios:
+            installed = scratch / "update"
+            run_manifest(cdn, installed, manifest, concurrency=args.concurrency)
+
+            new = depot.manifest(depot.change(layout, args.changed), gid=1001)
+            measure(
+                "update",
+                cdn,
+                installed,
+                new,
+                diff=ManifestDiff(manifest, new),
+                concurrency=args.concurrency,
+            )
+    finally:
+        if args.keep:
+            print("Scratch directory left in {}".format(scratch))
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
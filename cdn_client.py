@@ -0,0 +1,279 @@
+import time
+from collections import deque
+
+from gevent import Timeout, killall, spawn, wait
+from gevent.local import local
+from steam.client.cdn import CDNClient
+from steam.exceptions import SteamError
+
+import metrics
+from cdn_pool import server_pool
+from ratelimit import bandwidth_limiter
+
+# Servers a request is tried on before giving up
+MAX_ATTEMPTS = 4
+
+# (connect, read) socket timeouts for one request
+SOCKET_TIMEOUT = (5, 15)
+
+# Seconds one request may take in all, body included. A server trickling a chunk out slower than this is
+# treated as failed, which the socket timeouts alone wouldn't catch.
+REQUEST_TIMEOUT = 60
+
+# Default for the `hedge_budget` setting in `settings.json`
+DEFAULT_HEDGE_BUDGET = 0.05
+
+
+class HedgePolicy:
+    """
+    Class deciding when a slow chunk request gets a duplicate (a hedge) sent to another server.
+
+    The delay is the 95th percentile of recent chunk request times, so about one request in twenty is hedged
+    when the servers behave, and the ones stuck far out in the tail stop holding up their files. Hedges may add
+    at most `budget` (a fraction) to the bytes fetched; past that they are skipped until enough ordinary
+    traffic has gone by. A budget of 0 turns hedging off.
+    """
+
+    # Recent chunk request times the percentile is taken over
+    WINDOW = 500
+
+    # Requests seen before anything is hedged, and between two updates of the delay
+    MIN_SAMPLES = 50
+    UPDATE_EVERY = 25
+
+    # Shortest delay, so a fast cache next door doesn't get every request sent twice
+    MIN_DELAY = 0.05
+
+    def __init__(self, budget=DEFAULT_HEDGE_BUDGET):
+        """
+        Constructor method.
+        """
+        self.budget = budget
+        self.times = deque(maxlen=self.WINDOW)
+        self.since_update = 0
+        self.p95 = None
+        self.fetched_bytes = 0
+        self.hedged_bytes = 0
+
+    def observe(self, seconds, size):
+        """
+        Class method. Records a chunk request that took `seconds` and brought in `size` bytes.
+        """
+        self.times.append(seconds)
+        self.fetched_bytes += size
+        self.since_update += 1
+        if len(self.times) >= self.MIN_SAMPLES and self.since_update >= self.UPDATE_EVERY:
+            ordered = sorted(self.times)
+            self.p95 = ordered[int(0.95 * (len(ordered) - 1))]
+            self.since_update = 0
+
+    def delay(self):
+        """
+        Class method. Returns how many seconds a chunk request may run before it is hedged, or None if it won't be.
+        """
+        if self.budget <= 0 or self.p95 is None:
+            return None
+
+        return max(self.MIN_DELAY, self.p95)
+
+    def allow(self, size):
+        """
+        Class method. Takes `size` bytes out of the hedge budget. Returns False, leaving the budget alone, if
+        that would overspend it.
+        """
+        if self.hedged_bytes + size > self.budget * self.fetched_bytes:
+            metrics.hedges_skipped.inc()
+            return False
+
+        self.hedged_bytes += size
+        return True
+
+
+# Shared by every cdn client, like the server pool
+hedging = HedgePolicy()
+
+
+class SteamerCDNClient(CDNClient):
+    """
+    Class wrapping the steam CDN client with the bits Steamer needs on top of it.
+
+    Manifests are looked up in a `ManifestCache` before they are downloaded, so unchanged depots don't have to be
+    downloaded, decrypted and parsed again every night.
+
+    Requests don't go to whichever server steam listed first. They are spread over the content servers by the
+    shared `ServerPool`, with a time limit, and retried on other servers when one fails. Chunk requests stuck in
+    the slow tail are hedged with a copy sent to another server.
+
+    Chunk requests are timed in two parts: the http request itself (`cdn_cmd`), and everything else `get_chunk`
+    does with the response, which is decrypting and decompressing it.
+    """
+
+    def __init__(self, client, manifest_cache=None):
+        """
+        Constructor method. `client` is passed to the CDNClient constructor.
+        """
+        self.manifest_cache = manifest_cache
+        self.request_time = local()  # Time of the last cdn_cmd, per greenlet
+        CDNClient.__init__(self, client)
+        server_pool.sync(self.servers, self.web)
+
+    def cdn_cmd(self, command, args):
+        """
+        Class method. Same as `CDNClient.cdn_cmd`, but the server comes from the `ServerPool`, and a failed request
+        is tried again on another server, up to `MAX_ATTEMPTS` times. Chunk requests may be hedged; see
+        `HedgePolicy`. Notes how long it all took.
+        """
+        start = time.perf_counter()
+        try:
+            delay = hedging.delay() if "/chunk/" in args else None
+            if delay is None:
+                return self.send(command, args, set())
+
+            return self.send_hedged(command, args, delay)
+        finally:
+            self.request_time.value = time.perf_counter() - start
+
+    def send(self, command, args, tried):
+        """
+        Class method. Sends a request, moving on to another server each time one fails. `tried` collects the
+        servers used, so a hedge running alongside stays off them.
+        """
+        reason = "no content servers"
+        for _ in range(MAX_ATTEMPTS):
+            stats = server_pool.pick(exclude=tried)
+            if stats is None:
+                break
+
+            tried.add(stats.base)
+            resp, reason = self.request(stats, command, args)
+            if resp is not None:
+                return resp
+
+        raise SteamError("Request for {}/{} failed: {}".format(command, args, reason))
+
+    def race(self, command, args, tried, size=0):
+        """
+        Class method. `send` for a greenlet of `send_hedged`, returning `(response, error)` instead of raising.
+        A hedge first waits for `size` bytes of bandwidth, so it doesn't get around the user's limits.
+        """
+        try:
+            if size:
+                bandwidth_limiter.consume(size)
+
+            return self.send(command, args, tried), None
+        except Exception as e:
+            return None, e
+
+    def send_hedged(self, command, args, delay):
+        """
+        Class method. Sends a request, and if it hasn't come back after `delay` seconds sends it again to
+        another server, if the hedge budget allows. The first good response wins. Whatever racer is still
+        running when this returns, raises or is killed is dropped.
+        """
+        tried = set()
+        racers = [spawn(self.race, command, args, tried)]
+        try:
+            racers[0].join(delay)
+
+            if not racers[0].ready():
+                size = int(server_pool.typical_size)
+                if hedging.allow(size):
+                    metrics.hedges_fired.inc()
+                    racers.append(spawn(self.race, command, args, tried, size))
+
+            pending = list(racers)
+            error = None
+            while pending:
+                done = wait(pending, count=1)[0]
+                pending.remove(done)
+                resp, error = done.value
+                if resp is not None:
+                    if done is not racers[0]:
+                        metrics.hedges_won.inc()
+
+                    return resp
+
+            raise error
+        finally:
+            # Also when this greenlet is killed (the download was stopped), so no racer outlives it
+            killall([r for r in racers if not r.ready()], block=False)
+
+    def request(self, stats, command, args):
+        """
+        Class method. Sends one request to the server `stats` belongs to, and tells the pool how it went.
+
+        Returns: `(response, None)`, or `(None, reason)` if the server failed. Raises SteamError for 4xx
+        answers, which another server wouldn't answer any differently.
+        """
+        url = "{}/{}/{}".format(stats.base, command, args)
+        resp = None
+        server_pool.begin(stats)
+        start = time.perf_counter()
+        try:
+            with Timeout(REQUEST_TIMEOUT, False):
+                resp = self.web.get(url, timeout=SOCKET_TIMEOUT)
+        except Exception as e:
+            reason = str(e)
+            server_pool.failed(stats, reason)
+            return None, reason
+        finally:
+            server_pool.end(stats)
+
+        if resp is None:
+            reason = "timed out after {}s".format(REQUEST_TIMEOUT)
+        elif resp.ok:
+            seconds = time.perf_counter() - start
+            server_pool.succeeded(
+                stats, resp.elapsed.total_seconds(), seconds, len(resp.content)
+            )
+            if "/chunk/" in args:
+                hedging.observe(seconds, len(resp.content))
+
+            return resp, None
+        elif 400 <= resp.status_code < 500:
+            raise SteamError("HTTP Error {}".format(resp.status_code))
+        else:
+            reason = "HTTP Error {}".format(resp.status_code)
+
+        server_pool.failed(stats, reason)
+        return None, reason
+
+    def get_chunk(self, app_id, depot_id, chunk_id):
+        """
+        Class method. Same as `CDNClient.get_chunk`, recording fetch and decode times in `metrics`.
+        """
+        self.request_time.value = 0.0
+        start = time.perf_counter()
+        data = CDNClient.get_chunk(self, app_id, depot_id, chunk_id)
+        total = time.perf_counter() - start
+
+        fetch = self.request_time.value
+        if fetch > 0:
+            # Chunks served from the client's own cache made no request and aren't counted
+            metrics.chunk_fetch_seconds.observe(fetch)
+            metrics.chunk_decode_seconds.observe(max(0.0, total - fetch))
+
+        return data
+
+    def get_manifest(self, app_id, depot_id, manifest_gid, decrypt=True, **kwargs):
+        """
+        Class method. Same as `CDNClient.get_manifest`, but goes through the manifest cache for decrypted manifests.
+        """
+        key = (app_id, depot_id, manifest_gid)
+        if self.manifest_cache is None or not decrypt:
+            return CDNClient.get_manifest(
+                self, app_id, depot_id, manifest_gid, decrypt=decrypt, **kwargs
+            )
+
+        if key not in self.manifests:
+            data = self.manifest_cache.get(depot_id, manifest_gid)
+            if data is not None:
+                self.manifests[key] = self.DepotManifestClass(self, app_id, data)
+                return self.manifests[key]
+
+            manifest = CDNClient.get_manifest(
+                self, app_id, depot_id, manifest_gid, decrypt=decrypt, **kwargs
+            )
+            self.manifest_cache.put(depot_id, manifest_gid, manifest.serialize())
+
+        return self.manifests[key]
@@ -0,0 +1,306 @@
+import time
+
+from gevent import Timeout, spawn
+
+import metrics
+from logs import logger
+
+# Default for the `cdn_min_throughput` setting in `settings.json` (bytes per second)
+DEFAULT_MIN_SERVER_THROUGHPUT = 32 * 1024
+
+
+def server_base(server):
+    """
+    Function used for turning a steam `ContentServer` into the start of its urls, e.g. `https://host:443`.
+    """
+    return "{}://{}:{}".format(
+        "https" if server.https else "http", server.host, server.port
+    )
+
+
+class ServerStats:
+    """
+    Class holding the rolling scores and health of one content server.
+    """
+
+    def __init__(self, server):
+        """
+        Constructor method. `server` is a steam `ContentServer`.
+        """
+        self.server = server
+        self.base = server_base(server)
+        self.latency = None  # Seconds until the response headers are in
+        self.throughput = None  # Bytes per second once the body is flowing
+        self.samples = 0  # Successful requests since the server was last let in
+        self.inflight = 0
+        self.errors = 0  # Failures in a row
+        self.ejections = 0  # Ejections in a row; each one lasts twice as long as the last
+        self.ejected_until = 0.0
+        self.needs_probe = True
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def state(self, now):
+        """
+        Class method. Returns the scores as a dictionary.
+        """
+        return {
+            "server": self.base,
+            "latency_seconds": None if self.latency is None else round(self.latency, 4),
+            "bytes_per_second": None if self.throughput is None else round(self.throughput),
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "ejected_seconds": round(max(0.0, self.ejected_until - now), 1),
+            "probed": not self.needs_probe,
+        }
+
+
+class ServerPool:
+    """
+    Class choosing which content server each cdn request goes to.
+
+    Every server is probed once (a HEAD request, just to time the round trip) before it is used. After that,
+    each request updates rolling averages of its latency and throughput, and requests go to the server that
+    should finish a typical chunk soonest, counting the requests it already has in flight. Servers that fail
+    `MAX_ERRORS` requests in a row, or whose throughput drops below the floor, are ejected for a while and
+    probed again before they are let back in.
+
+    One pool is shared by every cdn client, the same way steam shares its server list between them.
+    """
+
+    # Failures in a row before a server is ejected
+    MAX_ERRORS = 2
+
+    # Seconds the first ejection lasts, and the most any ejection lasts
+    EJECT_BASE = 60.0
+    EJECT_MAX = 900.0
+
+    # Weight of the newest request in the rolling averages
+    ALPHA = 0.2
+
+    # Successful requests before a server's throughput is trusted enough to eject it for being slow
+    MIN_SAMPLES = 5
+
+    # Responses smaller than this are all latency, and don't say anything about throughput
+    MIN_RATE_SIZE = 64 * 1024
+
+    # A server slower than this fraction of the fastest one counts as below the floor too
+    RELATIVE_FLOOR = 0.2
+
+    # Seconds a probe may take
+    PROBE_TIMEOUT = 5.0
+
+    def __init__(self, min_throughput=DEFAULT_MIN_SERVER_THROUGHPUT):
+        """
+        Constructor method. `min_throughput` is the throughput floor, in bytes per second.
+        """
+        self.min_throughput = min_throughput
+        self.stats = {}  # base url -> ServerStats, in the order steam listed the servers
+        self.session = None
+        self.typical_size = 1024 * 1024.0  # Rolling average response size, starting at a full chunk
+
+    def sync(self, servers, session):
+        """
+        Class method. Brings the pool in line with steam's server list, keeping the scores of servers already
+        known, and starts probing the new ones. `session` is the requests session probes are sent with.
+        """
+        self.session = session
+        stats = {}
+        for server in servers:
+            base = server_base(server)
+            stats[base] = self.stats.get(base) or ServerStats(server)
+
+        self.stats = stats
+        for s in self.stats.values():
+            if s.needs_probe:
+                self.probe_later(s)
+
+    def probe_later(self, stats):
+        """
+        Class method. Probes a server in the background, unless that is already happening.
+        """
+        if not stats.probing and self.session is not None:
+            stats.probing = True
+            spawn(self.probe, stats)
+
+    def probe(self, stats):
+        """
+        Class method. Times a HEAD request to a server. Any answer at all lets the server in.
+        """
+        try:
+            with Timeout(self.PROBE_TIMEOUT):
+                resp = self.session.head(stats.base + "/", timeout=self.PROBE_TIMEOUT)
+        except (Exception, Timeout) as e:
+            self.eject(stats, "probe failed: {}".format(e))
+        else:
+            stats.latency = resp.elapsed.total_seconds()
+            stats.needs_probe = False
+            stats.samples = 0
+            stats.throughput = None
+        finally:
+            stats.probing = False
+
+    def usable(self, now, exclude=()):
+        """
+        Class method. Returns the probed servers that aren't ejected or in `exclude`.
+        """
+        return [
+            s
+            for s in self.stats.values()
+            if s.base not in exclude and not s.needs_probe and s.ejected_until <= now
+        ]
+
+    def cost(self, stats):
+        """
+        Class method. Returns roughly how many seconds a typical request to a server would take right now.
+
+        Servers without a throughput yet are given the best one seen, so they get tried.
+        """
+        latency = stats.latency if stats.latency is not None else 0.0
+        throughput = stats.throughput or self.best_throughput() or 1024 * 1024.0
+        return (latency + self.typical_size / throughput) * (1 + stats.inflight)
+
+    def best_throughput(self):
+        """
+        Class method. Returns the highest throughput of any server, or None.
+        """
+        known = [s.throughput for s in self.stats.values() if s.throughput]
+        return max(known) if known else None
+
+    def floor(self):
+        """
+        Class method. Returns the throughput a server has to keep up to stay in the pool.
+        """
+        return max(self.min_throughput, self.RELATIVE_FLOOR * (self.best_throughput() or 0))
+
+    def pick(self, exclude=()):
+        """
+        Class method. Returns the `ServerStats` of the server the next request should go to, or None if steam
+        didn't list any. Servers in `exclude` (base urls) are only used if nothing else is left.
+
+        While the first probes are out, unprobed servers are used in steam's order. If every server is ejected,
+        the one that comes back soonest is used anyway rather than stopping the downloads.
+        """
+        now = time.monotonic()
+        # Servers whose ejection ran out are probed before they get traffic again
+        for s in self.stats.values():
+            if s.needs_probe and s.ejected_until <= now:
+                self.probe_later(s)
+
+        usable = self.usable(now, exclude)
+        if usable:
+            return min(usable, key=self.cost)
+
+        waiting = [
+            s for s in self.stats.values() if s.base not in exclude and s.ejected_until <= now
+        ]
+        if waiting:
+            return waiting[0]
+
+        rest = [s for s in self.stats.values() if s.base not in exclude] or list(
+            self.stats.values()
+        )
+        return min(rest, key=lambda s: s.ejected_until) if rest else None
+
+    def begin(self, stats):
+        """
+        Class method. Counts a request to a server as in flight.
+        """
+        stats.inflight += 1
+        stats.requests += 1
+
+    def end(self, stats):
+        """
+        Class method. Counts a request to a server as no longer in flight, however it went.
+        """
+        stats.inflight -= 1
+
+    def succeeded(self, stats, latency, seconds, size):
+        """
+        Class method. Folds a successful request into a server's scores: `latency` seconds until the headers,
+        `seconds` in all, `size` bytes of body. A server that has slowed to below the floor is ejected, as long
+        as there is another one to use.
+        """
+        stats.errors = 0
+        stats.samples += 1
+        stats.bytes += size
+        if stats.samples >= self.MIN_SAMPLES:
+            stats.ejections = 0
+
+        stats.latency = (
+            latency
+            if stats.latency is None
+            else stats.latency + self.ALPHA * (latency - stats.latency)
+        )
+        self.typical_size += self.ALPHA * (size - self.typical_size)
+
+        transfer = seconds - latency
+        if size >= self.MIN_RATE_SIZE and transfer > 0:
+            rate = size / transfer
+            stats.throughput = (
+                rate
+                if stats.throughput is None
+                else stats.throughput + self.ALPHA * (rate - stats.throughput)
+            )
+
+        if (
+            stats.samples >= self.MIN_SAMPLES
+            and stats.throughput is not None
+            and stats.throughput < self.floor()
+            and len(self.usable(time.monotonic(), (stats.base,))) > 0
+        ):
+            self.eject(
+                stats,
+                "{:.0f} KiB/s is below the floor of {:.0f} KiB/s".format(
+                    stats.throughput / 1024, self.floor() / 1024
+                ),
+            )
+
+    def failed(self, stats, reason):
+        """
+        Class method. Counts a failed request against a server, ejecting it after `MAX_ERRORS` in a row.
+        """
+        stats.errors += 1
+        stats.failures += 1
+        metrics.cdn_request_errors.inc()
+        logger.debug("Request to cdn server %s failed: %s", stats.base, reason)
+
+        if stats.errors >= self.MAX_ERRORS:
+            self.eject(stats, reason)
+
+    def eject(self, stats, reason):
+        """
+        Class method. Takes a server out of the pool for a while. It is probed again before it is let back in,
+        with its throughput forgotten so it gets a fresh chance.
+        """
+        cooldown = min(self.EJECT_MAX, self.EJECT_BASE * 2 ** stats.ejections)
+        stats.ejections += 1
+        stats.ejected_until = time.monotonic() + cooldown
+        stats.needs_probe = True
+        stats.errors = 0
+        stats.samples = 0
+        stats.throughput = None
+        metrics.cdn_server_ejections.inc()
+        logger.warning(
+            "Ejected cdn server %s for %.0fs: %s", stats.base, cooldown, reason
+        )
+
+    def state(self):
+        """
+        Class method. Returns the scores of every server as a list, best first.
+        """
+        now = time.monotonic()
+        usable = set(s.base for s in self.usable(now))
+        ordered = sorted(
+            self.stats.values(),
+            key=lambda s: (s.base not in usable, self.cost(s) if s.base in usable else 0),
+        )
+        return [s.state(now) for s in ordered]
+
+
+# Shared by every cdn client
+server_pool = ServerPool()
@@ -1,17 +1,54 @@
 from steam.client import SteamClient
-from steam.client.cdn import CDNClient
-import sqlite3
+from cdn_client import DEFAULT_HEDGE_BUDGET, SteamerCDNClient, hedging
+from cdn_pool import DEFAULT_MIN_SERVER_THROUGHPUT, server_pool
+from manifest_cache import (
+    ManifestCache,
+    DEFAULT_MANIFEST_CACHE_DIR,
+    DEFAULT_MANIFEST_CACHE_SIZE,
+)
 from pathlib import Path
-from dl_handler import manifest_process_factory
-from multiprocessing import Pipe
+from dl_handler import ManifestProcess, DEFAULT_CHUNK_CONCURRENCY
+from writer import DEFAULT_WRITE_BUFFER_SIZE, DEFAULT_FSYNC_POLICY
+import argparse
 import json
-from gevent import spawn
-from gevent.socket import wait_write, wait_read
-from db import query_builder
+import hashlib
+import sqlite3
+import sys
+from gevent import Timeout, spawn
+from gevent.pool import Pool
+from db import query_builder, connection
 from timelimits import TimeRange
+from ratelimit import bandwidth_limiter, parse_bandwidth_limits
+from scheduler import DownloadScheduler, DEFAULT_MAX_ACTIVE_DOWNLOADS
+from progress import download_states
+from verify import verify_install
+from logs import (
+    setup_logging,
+    DEFAULT_LOG_FILE,
+    DEFAULT_LOG_MAX_BYTES,
+    DEFAULT_LOG_BACKUPS,
+    DEFAULT_LOG_LEVEL,
+)
 
 import time
 
+# Bumped whenever `migrate_db` learns a new step
+SCHEMA_VERSION = 3
+
+# Apps per get_product_info request, and how many of those requests are in flight at once
+POPULATE_BATCH_SIZE = 100
+POPULATE_CONCURRENCY = 4
+
+
+def split_filter_values(value):
+    """
+    Function used for splitting a comma separated os/language column into normalized values.
+    """
+    if not value:
+        return []
+
+    return [v.strip().lower() for v in str(value).split(",") if v.strip() != ""]
+
 
 class LocalSteamClient(SteamClient):
     """
@@ -25,7 +62,6 @@ class LocalSteamClient(SteamClient):
 
         Initalizes class by setting credential location, attempting login, and setting up the database.
         """
-        self.db_conn = None
         SteamClient.__init__(self, *args, **kwargs)
         self.set_credential_location(
             "."
@@ -35,14 +71,19 @@ class LocalSteamClient(SteamClient):
         self.download_location: Path = Path(".")
         self.os_list = []
         self.languages = []
+        self.chunk_concurrency = DEFAULT_CHUNK_CONCURRENCY
+        self.write_buffer_size = DEFAULT_WRITE_BUFFER_SIZE
+        self.fsync_policy = DEFAULT_FSYNC_POLICY
+        self.manifest_cache = None
+        self.scheduler = DownloadScheduler()
+        self.sync_progress = {"running": False}
         self.load_settings_from_file("settings.json")
 
         self.init_db()
         if self.logged_on:
-            self.cdn = CDNClient(self)
+            self.cdn = SteamerCDNClient(self, self.manifest_cache)
         else:
             self.cdn = None
-        self.process_list = []
 
     def init_db(self):
         """
@@ -50,37 +91,174 @@ class LocalSteamClient(SteamClient):
 
         If the database already exists, nothing is done.
         """
-        self.db_conn = sqlite3.connect("steamer.db")
+        with connection() as conn:
+            # Make tables if they don't exist
+            conn.execute(
+                """
+                create table if not exists apps (
+                    app_id number PRIMARY KEY,
+                    name text,
+                    logo text,
+                    dl_dir text,
+                    oses test,
+                    langs text
+                )
+            """
+            )
 
-        # Make tables if they don't exist
-        self.db_conn.execute(
+            conn.execute(
+                """
+                create table if not exists sync_state (
+                    key text PRIMARY KEY,
+                    value text
+                )
             """
-            create table if not exists apps (
-                app_id number PRIMARY KEY,
-                name text,
-                logo text,
-                dl_dir text,
-                oses test,
-                langs text
             )
+
+            conn.execute(
+                """
+                create table if not exists depots (
+                    depot_id number,
+                    app_id number,
+                    name text,
+                    size number,
+                    is_dlc bool,
+                    oses text,
+                    langs text
+                )
+            """
+            )
+
+            self.migrate_db(conn)
+            self.refresh_app_sizes(conn, only_if_missing=True)
+
+    def migrate_db(self, conn):
         """
-        )
+        Class method. Brings an existing `steamer.db` up to `SCHEMA_VERSION`, tracked with `pragma user_version`.
+
+        Version 1: index depots by app, and split the comma separated os/language columns of depots into
+        `depot_os` and `depot_lang` so the settings filters can use indexed lookups instead of `like '%x%'` scans.
+
+        Version 2: index apps by name for paging through the library, and add the `apps_fts` full text index.
+
+        Version 3: add the `app_sizes` table.
+        """
+        version = conn.execute("pragma user_version").fetchone()[0]
+
+        if version < 1:
+            conn.execute(
+                "create index if not exists depots_by_app on depots (app_id, depot_id)"
+            )
+            conn.execute(
+                """
+                create table if not exists depot_os (
+                    app_id number,
+                    depot_id number,
+                    os text
+                )
+            """
+            )
+            conn.execute(
+                "create index if not exists depot_os_lookup on depot_os (app_id, depot_id, os)"
+            )
+            conn.execute(
+                """
+                create table if not exists depot_lang (
+                    app_id number,
+                    depot_id number,
+                    lang text
+                )
+            """
+            )
+            conn.execute(
+                "create index if not exists depot_lang_lookup on depot_lang (app_id, depot_id, lang)"
+            )
+
+            # Fill them in from what is already in the depots table
+            conn.execute("delete from depot_os")
+            conn.execute("delete from depot_lang")
+            rows = conn.execute(
+                "select depot_id, app_id, name, size, is_dlc, oses, langs from depots"
+            ).fetchall()
+            self.store_depot_filters(conn, rows)
 
-        self.db_conn.execute(
+            conn.execute("pragma user_version = 1")
+
+        if version < 2:
+            # Keyset pagination of the library walks this index
+            conn.execute(
+                "create index if not exists apps_by_name on apps (name, app_id)"
+            )
+
+            # Full text index over app names, with the app id as its rowid. Kept in sync by triggers.
+            try:
+                conn.execute(
+                    "create virtual table if not exists apps_fts using fts5(name, tokenize='unicode61 remove_diacritics 2')"
+                )
+            except sqlite3.OperationalError:
+                print("This sqlite build has no FTS5; searching the library will be slower")
+            else:
+                conn.execute(
+                    """
+                    create trigger if not exists apps_fts_insert after insert on apps begin
+                        insert into apps_fts(rowid, name) values (new.app_id, new.name);
+                    end
+                """
+                )
+                conn.execute(
+                    """
+                    create trigger if not exists apps_fts_delete after delete on apps begin
+                        delete from apps_fts where rowid = old.app_id;
+                    end
+                """
+                )
+                conn.execute(
+                    """
+                    create trigger if not exists apps_fts_update after update of name on apps begin
+                        update apps_fts set name = new.name where rowid = old.app_id;
+                    end
+                """
+                )
+                conn.execute("delete from apps_fts")
+                conn.execute("insert into apps_fts(rowid, name) select app_id, name from apps")
+
+            conn.execute("pragma user_version = 2")
+
+        if version < 3:
+            # Download size of every app under a set of os/language filters, see `refresh_app_sizes`
+            conn.execute(
+                """
+                create table if not exists app_sizes (
+                    filter_hash text,
+                    app_id number,
+                    size number,
+                    depot_count number,
+                    downloadable bool,
+                    primary key (filter_hash, app_id)
+                )
             """
-            create table if not exists depots (
-                depot_id number,
-                app_id number,
-                name text,
-                size number,
-                is_dlc bool,
-                oses text,
-                langs text
             )
+            conn.execute(
+                "create index if not exists app_sizes_by_size on app_sizes (filter_hash, size)"
+            )
+
+            conn.execute("pragma user_version = 3")
+
+    def store_depot_filters(self, conn, depot_list):
         """
-        )
+        Class method. Fills `depot_os` and `depot_lang` for rows of the depots table. Values are split on commas
+        and lower cased.
+        """
+        os_rows = []
+        lang_rows = []
+        for d_id, app_id, _, _, _, oses, langs in depot_list:
+            for os_name in split_filter_values(oses):
+                os_rows.append((app_id, d_id, os_name))
+            for lang in split_filter_values(langs):
+                lang_rows.append((app_id, d_id, lang))
 
-        self.db_conn.commit()
+        conn.executemany("insert into depot_os VALUES(?, ?, ?)", os_rows)
+        conn.executemany("insert into depot_lang VALUES(?, ?, ?)", lang_rows)
 
     def force_login(self):
         """
@@ -106,6 +284,19 @@ class LocalSteamClient(SteamClient):
                 "download_location": str(Path("./.downloads").resolve()),
                 "os_list": ["windows"],
                 "languages": ["english"],
+                "chunk_concurrency": DEFAULT_CHUNK_CONCURRENCY,
+                "write_buffer_size": DEFAULT_WRITE_BUFFER_SIZE,
+                "fsync_policy": DEFAULT_FSYNC_POLICY,
+                "manifest_cache_dir": DEFAULT_MANIFEST_CACHE_DIR,
+                "manifest_cache_size": DEFAULT_MANIFEST_CACHE_SIZE,
+                "bandwidth_limits": [],
+                "cdn_min_throughput": DEFAULT_MIN_SERVER_THROUGHPUT,
+                "hedge_budget": DEFAULT_HEDGE_BUDGET,
+                "max_concurrent_downloads": DEFAULT_MAX_ACTIVE_DOWNLOADS,
+                "log_file": DEFAULT_LOG_FILE,
+                "log_max_bytes": DEFAULT_LOG_MAX_BYTES,
+                "log_backups": DEFAULT_LOG_BACKUPS,
+                "log_level": DEFAULT_LOG_LEVEL,
             }
 
             with open(p, "w") as f:
@@ -118,6 +309,42 @@ class LocalSteamClient(SteamClient):
             self.download_location = Path(data["download_location"])
             self.os_list = data["os_list"]
             self.languages = data["languages"]
+            self.chunk_concurrency = data.get(
+                "chunk_concurrency", DEFAULT_CHUNK_CONCURRENCY
+            )
+            self.write_buffer_size = data.get(
+                "write_buffer_size", DEFAULT_WRITE_BUFFER_SIZE
+            )
+            self.fsync_policy = data.get("fsync_policy", DEFAULT_FSYNC_POLICY)
+            self.manifest_cache = ManifestCache(
+                data.get("manifest_cache_dir", DEFAULT_MANIFEST_CACHE_DIR),
+                data.get("manifest_cache_size", DEFAULT_MANIFEST_CACHE_SIZE),
+            )
+            if getattr(self, "cdn", None) is not None:
+                self.cdn.manifest_cache = self.manifest_cache
+
+            bandwidth_limiter.set_schedule(
+                parse_bandwidth_limits(data.get("bandwidth_limits", []))
+            )
+            server_pool.min_throughput = int(
+                data.get("cdn_min_throughput", DEFAULT_MIN_SERVER_THROUGHPUT)
+            )
+            hedging.budget = float(data.get("hedge_budget", DEFAULT_HEDGE_BUDGET))
+
+            self.scheduler.max_active = max(
+                1,
+                int(
+                    data.get("max_concurrent_downloads", DEFAULT_MAX_ACTIVE_DOWNLOADS)
+                ),
+            )
+            self.scheduler.promote()
+
+            setup_logging(
+                data.get("log_file", DEFAULT_LOG_FILE),
+                data.get("log_max_bytes", DEFAULT_LOG_MAX_BYTES),
+                data.get("log_backups", DEFAULT_LOG_BACKUPS),
+                data.get("log_level", DEFAULT_LOG_LEVEL),
+            )
 
     def update_settings(self, settings_filepath, data):
         """
@@ -135,8 +362,13 @@ class LocalSteamClient(SteamClient):
             f.write(json.dumps(current_settings))
 
         # Re-read the settings back into the object
+        old_hash = self.filter_hash()
         self.load_settings_from_file(settings_filepath)
 
+        if self.filter_hash() != old_hash:
+            with connection() as conn:
+                self.refresh_app_sizes(conn)
+
     def get_settings_as_json(self):
         """
         Class method. Returns the settings in the file as a dictionary
@@ -156,40 +388,156 @@ class LocalSteamClient(SteamClient):
         - Depot info, including name, app id, depot id, size (in bytes), and a boolean is_dlc marker.
 
         Note: Often very slow. The SteamClient emulates a, well, Steam client, without actually being Steam itself.
-        It's just very slow, but is faster when the database is populated.
+        It's just very slow, but is faster when the database is populated. Progress can be followed through
+        `self.sync_progress`.
+        """
+        if self.sync_progress["running"]:
+            print("A populate is already running.")
+            return
+
+        self.sync_progress = {"running": True, "started": time.time()}
+        try:
+            self.sync_apps()
+        finally:
+            self.sync_progress["running"] = False
+            self.sync_progress["finished"] = time.time()
+
+    def sync_apps(self):
+        """
+        Class method. Does the work for `populate_apps`, streaming product info into the database in batches
+        of `POPULATE_BATCH_SIZE` apps and recording its progress in `self.sync_progress`.
         """
         start = time.time()
 
         # Ensure the client is logged in
         if not self.logged_on and self.relogin_available:
             self.relogin()
-            self.cdn = CDNClient(self)
+            self.cdn = SteamerCDNClient(self, self.manifest_cache)
 
         # Grab the ids from the cdn
         print("Loading licenses into CDN")
         if self.cdn is None:
-            self.cdn = CDNClient(self)
+            self.cdn = SteamerCDNClient(self, self.manifest_cache)
 
         self.cdn.load_licenses()
 
-        ids = list(self.cdn.licensed_app_ids)
+        licensed = set(self.cdn.licensed_app_ids)
 
         # Check the list of ids agains the ones in the database
-        db_ids = self.db_conn.execute("select app_id from apps").fetchall()
-        db_ids = list(sum(db_ids, ()))
+        with connection() as conn:
+            db_ids = conn.execute("select app_id from apps").fetchall()
+        db_ids = set(sum(db_ids, ()))
 
-        ids = list(set(ids).symmetric_difference(set(db_ids)))
-        ids.sort()
-        # print(ids)
+        ids, change_number = self.get_changed_app_ids(licensed, db_ids)
 
         if len(ids) == 0:
             print("There is nothing to do.")
+            if change_number is not None:
+                self.set_sync_state("pics_change_number", change_number)
             return
 
-        # call steam.get_product_info with these ids
-        print("Reading from get_product_info. . .")
-        apps = self.get_product_info(apps=ids)  # This will take some time. . .
+        # call steam.get_product_info with these ids, a batch at a time
+        batches = [
+            ids[i : i + POPULATE_BATCH_SIZE]
+            for i in range(0, len(ids), POPULATE_BATCH_SIZE)
+        ]
+        print(
+            "Reading from get_product_info for {} apps in {} batches. . .".format(
+                len(ids), len(batches)
+            )
+        )
+        self.sync_progress.update(
+            {
+                "total_apps": len(ids),
+                "done_apps": 0,
+                "total_batches": len(batches),
+                "done_batches": 0,
+                "failed_batches": 0,
+            }
+        )
 
+        # Each batch is committed as soon as it arrives, so a failure only loses the batches still in flight
+        pool = Pool(POPULATE_CONCURRENCY)
+        for batch, result in pool.imap_unordered(
+            self.fetch_product_info_batch, batches
+        ):
+            if result is None:
+                self.sync_progress["failed_batches"] += 1
+                continue
+
+            app_list, depot_list = result
+            self.store_apps(app_list, depot_list)
+            self.sync_progress["done_batches"] += 1
+            self.sync_progress["done_apps"] += len(batch)
+
+        # Only move the change number forward once everything it covers is stored
+        if change_number is not None and self.sync_progress["failed_batches"] == 0:
+            self.set_sync_state("pics_change_number", change_number)
+
+        end = time.time()
+        print(f"Elapsed {end-start} seconds")
+
+    def fetch_product_info_batch(self, ids):
+        """
+        Class method. Reads the product info for a batch of app ids and parses it.
+
+        Returns:
+        - (ids:list, (app_list, depot_list) | None) -> None if Steam didn't answer.
+        """
+        try:
+            apps = self.get_product_info(apps=ids)  # This will take some time. . .
+        except (Exception, Timeout) as e:
+            # A batch Steam doesn't answer in time raises gevent's Timeout, which isn't an Exception
+            print("get_product_info failed for a batch: ", e)
+            return ids, None
+
+        if apps is None:
+            return ids, None
+
+        return ids, self.parse_product_info(apps)
+
+    def get_changed_app_ids(self, licensed, db_ids):
+        """
+        Class method. Works out which licensed apps need their product info read, using the PICS change number
+        stored by the last sync. New licenses are always included, and apps already in the database are only
+        included if Steam says they changed since then. Without a stored change number (or when Steam asks
+        for it) every licensed app is refreshed.
+
+        Returns:
+        - (ids:list, change_number:int|None) -> The change number to store once the ids are synced.
+        """
+        new_ids = licensed - db_ids
+
+        last = self.get_sync_state("pics_change_number")
+        resp = self.get_changes_since(
+            int(last) if last is not None else 0,
+            app_changes=True,
+            package_changes=False,
+        )
+
+        if resp is None:
+            print("Steam didn't answer the change request, only adding new apps")
+            return sorted(new_ids), None
+
+        if last is None or resp.force_full_update or resp.force_full_app_update:
+            print("Refreshing every licensed app")
+            return sorted(licensed), resp.current_change_number
+
+        changed = set(change.appid for change in resp.app_changes) & licensed
+        print(
+            "{} new apps, {} changed since change number {}".format(
+                len(new_ids), len(changed - new_ids), last
+            )
+        )
+        return sorted(new_ids | changed), resp.current_change_number
+
+    def parse_product_info(self, apps):
+        """
+        Class method. Turns the response of `get_product_info` into rows for the apps and depots tables.
+
+        Returns:
+        - (app_list:list, depot_list:list)
+        """
         # iterate over the returned apps to populate the database (eventually?)
         print("Iterating over apps and depots")
         app_list = []
@@ -304,19 +652,54 @@ class LocalSteamClient(SteamClient):
 
                 depot_list.append((d_id, app_id, d_name, size, dlc, oses, langs))
 
-        # Out of the loop
-        # Add the items to the database
-        self.db_conn.executemany("insert into apps VALUES(?, ?, ?, ?, ?, ?)", app_list)
-        self.db_conn.executemany(
-            "insert into depots VALUES(?, ?, ?, ?, ?, ?, ?)", depot_list
-        )
-        self.db_conn.commit()
+        return app_list, depot_list
 
-        end = time.time()
-        print(f"Elapsed {end-start} seconds")
+    def store_apps(self, app_list, depot_list):
+        """
+        Class method. Upserts rows from `parse_product_info` into the database. The depots of every app in
+        `app_list` are replaced.
+        """
+        app_ids = [(row[0],) for row in app_list]
+        with connection() as conn:
+            # Plain deletes rather than `insert or replace`, which would skip the delete triggers
+            for table in ("apps", "depots", "depot_os", "depot_lang", "app_sizes"):
+                conn.executemany("delete from {} where app_id=?".format(table), app_ids)
+            conn.executemany("insert into apps VALUES(?, ?, ?, ?, ?, ?)", app_list)
+            conn.executemany(
+                "insert into depots VALUES(?, ?, ?, ?, ?, ?, ?)", depot_list
+            )
+            self.store_depot_filters(conn, depot_list)
+            self.refresh_app_sizes(conn, [row[0] for row in app_list])
+
+    def get_sync_state(self, key):
+        """
+        Class method. Returns a value stored by `set_sync_state`, or None.
+        """
+        with connection() as conn:
+            row = conn.execute(
+                "select value from sync_state where key=?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def set_sync_state(self, key, value):
+        """
+        Class method. Stores a value that has to survive between syncs, like the last PICS change number.
+        """
+        with connection() as conn:
+            conn.execute(
+                "insert or replace into sync_state VALUES(?, ?)", (key, str(value))
+            )
 
     def download_app(
-        self, app_id: int, time_range: TimeRange, download_path: Path = None
+        self,
+        app_id: int,
+        time_range: TimeRange,
+        download_path: Path = None,
+        priority: int = 0,
     ):
         """
         Class method. Wraps calls to the download handler, which itself is wrapped in a gevent spawn command.
@@ -325,96 +708,218 @@ class LocalSteamClient(SteamClient):
         - app_id: int -> The app id to download.
         - time_range: TimeRange -> The time the app is able to be downloaded during.
         - download_path: (Path | None) -> The path the download the content to.
+        - priority: int -> Higher priorities get a download slot first.
 
-        Adds information on the greenlit to `self.process_list`
+        Adds the process to the queue in `self.scheduler`, which decides when it may download.
         """
-        local_conn, proc_conn = Pipe()
-        if download_path is None:
-            download_path = self.download_location
-
-        # Grab the game's name to put as the filepath like Steam does.
-        dl_dir = self.db_conn.execute(
-            "select dl_dir from apps where app_id=?", (app_id,)
-        ).fetchone()[0]
-        download_path = Path(download_path)
-        download_path = download_path / str(dl_dir)
+        download_path = self.install_dir_for(app_id, download_path)
 
         # Get the whitelist of depots for the app_id
         depot_whitelist = self.get_filtered_depots_for_app(app_id)
 
         if self.cdn is None:
-            self.cdn = CDNClient(self)
+            self.cdn = SteamerCDNClient(self, self.manifest_cache)
 
-        # proc = Process(target=manifest_process_factory, args=(proc_conn, self.cdn, download_path,), kwargs={'timerange': time_range}, daemon=True)
-        proc = spawn(
-            manifest_process_factory,
-            proc_conn,
+        proc = ManifestProcess(
             self.cdn,
             download_path,
             timerange=time_range,
             depot_whitelist=depot_whitelist,
+            chunk_concurrency=self.chunk_concurrency,
+            scheduler=self.scheduler,
+            write_buffer_size=self.write_buffer_size,
+            fsync_policy=self.fsync_policy,
         )
-        proc.start()
-        local_conn.send(["download", app_id])
-
-        # add the process and some info to the process list
-        self.process_list.append((local_conn, app_id, time_range))
+        self.scheduler.add(proc, app_id, priority=priority)
+        spawn(proc.run)
+        proc.send(["download", app_id])
 
-        # Return the PID to search by for later
         return proc
 
+    def install_dir_for(self, app_id: int, download_path: Path = None):
+        """
+        Class method. Returns the directory an app is downloaded to: its install folder name (like Steam uses)
+        inside `download_path`, or inside the download location from the settings.
+        """
+        if download_path is None:
+            download_path = self.download_location
+
+        # Grab the game's name to put as the filepath like Steam does.
+        with connection() as conn:
+            dl_dir = conn.execute(
+                "select dl_dir from apps where app_id=?", (app_id,)
+            ).fetchone()[0]
+
+        return Path(download_path) / str(dl_dir)
+
+    def verify_app(self, app_id: int, workers=None, update=True):
+        """
+        Class method. Checks the files of an installed app against its manifests. See `verify.verify_install`.
+
+        Inputs:
+        - app_id: int -> The app to check.
+        - workers: (int | None) -> Number of hashing processes, one per core by default.
+        - update: bool -> Record the results in the chunk journals, so the next download of the app only fetches
+          the bad chunks.
+        """
+        return verify_install(
+            app_id, self.install_dir_for(app_id), workers=workers, update=update
+        )
+
     def check_download_state_all(self):
         """
-        Class method. Polls all processes it knows of, and queries their state.
+        Class method. Looks at the state of all processes it knows of, as last pushed to `download_states`.
+        Never waits on the download greenlets.
 
         Returns:
-        - List (app_id:int, running:str)
+        - List of dictionaries from `ManifestProcess.state`: bytes done and total for the app and each depot,
+          chunks per second, moving average throughput and ETA.
         """
-        state = []
-        for item in self.process_list:
-            wait_write(item[0].fileno())
-            item[0].send("query")
-            wait_read(item[0].fileno())
-            running = item[0].recv()
+        return download_states.snapshot()
 
-            state.append((item[1], running))
+    def filter_hash(self):
+        """
+        Class method. Returns a short hash of the os/language filters, used to key `app_sizes`.
+        """
+        oses = sorted(set(o.strip().lower() for o in self.os_list))
+        langs = sorted(set(lang.strip().lower() for lang in self.languages))
+        payload = json.dumps([oses, langs]).encode()
+
+        return hashlib.sha1(payload).hexdigest()[:16]
+
+    def depot_filter_clause(self):
+        """
+        Class method. Returns `(sql, values)` for the part of a where clause that keeps only the rows of
+        `depots d` visible with the current filters on both language and os.
+        """
+        oses = [o.strip().lower() for o in self.os_list]
+        langs = [lang.strip().lower() for lang in self.languages]
+
+        # Depots that don't say which os/language they are for always pass
+        query_string = ""
+        filter_vals = []
+        if len(oses) > 0:
+            query_string += query_builder(
+                " and (coalesce(d.oses, '') = '' or exists (select 1 from depot_os o"
+                " where o.app_id = d.app_id and o.depot_id = d.depot_id and o.os in (?",
+                ", ?",
+                len(oses) - 1,
+                ")))",
+            )
+            filter_vals.extend(oses)
+        if len(langs) > 0:
+            query_string += query_builder(
+                " and (coalesce(d.langs, '') = '' or exists (select 1 from depot_lang l"
+                " where l.app_id = d.app_id and l.depot_id = d.depot_id and l.lang in (?",
+                ", ?",
+                len(langs) - 1,
+                ")))",
+            )
+            filter_vals.extend(langs)
 
-        return state
+        return query_string, filter_vals
 
     def get_filtered_depots_for_app(self, app_id):
         """
         Class method. Returns a list of depot id's that are visible with the current
         filters on both language and os.
         """
-        filter_vals = self.os_list[:]
-        oses_string = query_builder(
-            "(oses like ?", "or oses like ?", len(self.os_list) - 1, " or oses='')"
-        )
-
-        filter_vals.extend(self.languages[:])
-        langs_string = query_builder(
-            "(langs like ?", "or langs like ?", len(self.languages) - 1, " or langs='')"
-        )
+        clause, filter_vals = self.depot_filter_clause()
+        query_string = "select d.depot_id from depots d where d.app_id = ?" + clause
 
-        query_string = "select depot_id from depots where app_id = ? "
-        if len(self.os_list) > 0:
-            query_string += " and " + oses_string
-        if len(self.os_list) > 0 and len(self.languages) > 0:
-            query_string += " and " + langs_string
-        elif len(self.languages) > 0 and len(self.os_list) < 1:
-            query_string += " " + langs_string
+        with connection() as conn:
+            depot_info = list(
+                sum(conn.execute(query_string, [int(app_id)] + filter_vals).fetchall(), ())
+            )
+        return depot_info
 
-        query_string += " collate nocase"
+    def refresh_app_sizes(self, conn, app_ids=None, only_if_missing=False):
+        """
+        Class method. Recomputes `app_sizes` for the current filters, for `app_ids` or for every app.
 
-        # select * from depots where app_id=? and ([oses like '%?[oses]%'] or oses like '') and (langs like '%?[langs]%' or langs like '') collate nocase
+        An app's size is the total of the depots that pass the filters. Apps where nothing passes can't be
+        downloaded; they keep the total of all their depots so the page still has something to show.
+        Rows for other filter sets are dropped on a full refresh, since nothing keeps them up to date.
 
-        filter_vals = ["%" + i + "%" for i in filter_vals]
-        filter_vals.insert(0, int(app_id))
+        With `only_if_missing`, nothing is done if the current filters already have rows.
+        """
+        key = self.filter_hash()
+        if only_if_missing:
+            if conn.execute(
+                "select 1 from app_sizes where filter_hash=? limit 1", (key,)
+            ).fetchone():
+                return
+
+        clause, filter_vals = self.depot_filter_clause()
+        scope = ""
+        scope_vals = []
+        if app_ids is None:
+            conn.execute("delete from app_sizes")
+        else:
+            if len(app_ids) == 0:
+                return
+            scope = query_builder(" and d.app_id in (?", ", ?", len(app_ids) - 1, ")")
+            scope_vals = [int(a) for a in app_ids]
+            conn.execute(
+                query_builder(
+                    "delete from app_sizes where filter_hash=? and app_id in (?",
+                    ", ?",
+                    len(app_ids) - 1,
+                    ")",
+                ),
+                [key] + scope_vals,
+            )
 
-        depot_info = list(
-            sum(self.db_conn.execute(query_string, filter_vals).fetchall(), ())
+        conn.execute(
+            "insert into app_sizes select ?, d.app_id, sum(d.size), count(*), 1 from depots d where 1"
+            + clause
+            + scope
+            + " group by d.app_id",
+            [key] + filter_vals + scope_vals,
         )
-        return depot_info
+        conn.execute(
+            "insert or ignore into app_sizes select ?, d.app_id, sum(d.size), 0, 0 from depots d where 1"
+            + scope
+            + " group by d.app_id",
+            [key] + scope_vals,
+        )
+
+    def get_app_size(self, app_id: int):
+        """
+        Class method. Returns `(size, downloadable)` for an app under the current filters.
+        """
+        key = self.filter_hash()
+        with connection() as conn:
+            row = conn.execute(
+                "select size, downloadable from app_sizes where filter_hash=? and app_id=?",
+                (key, int(app_id)),
+            ).fetchone()
+
+            if row is None:
+                # Not refreshed yet, work it out now
+                self.refresh_app_sizes(conn, [app_id])
+                row = conn.execute(
+                    "select size, downloadable from app_sizes where filter_hash=? and app_id=?",
+                    (key, int(app_id)),
+                ).fetchone()
+
+        if row is None:
+            return 0, False
+
+        return row[0] or 0, bool(row[1])
+
+    def get_largest_apps(self, limit: int = 20):
+        """
+        Class method. Returns `(app_id, name, size)` for the biggest downloadable apps under the current filters.
+        """
+        with connection() as conn:
+            out = conn.execute(
+                "select s.app_id, a.name, s.size from app_sizes s join apps a on a.app_id = s.app_id"
+                " where s.filter_hash=? and s.downloadable order by s.size desc limit ?",
+                (self.filter_hash(), int(limit)),
+            ).fetchall()
+
+        return out
 
     def get_apps(self):
         """
@@ -422,10 +927,10 @@ class LocalSteamClient(SteamClient):
 
         Outdated and unused due to Flask using gevent. It's just easier to access the database directy.
         """
-        self.init_db()
-        out = self.db_conn.execute(
-            "select * from apps where name not like '%Server%' and logo not like '' order by name ASC"
-        ).fetchall()
+        with connection() as conn:
+            out = conn.execute(
+                "select * from apps where name not like '%Server%' and logo not like '' order by name ASC"
+            ).fetchall()
 
         if len(out) == 0:
             self.populate_apps()
@@ -442,13 +947,59 @@ class LocalSteamClient(SteamClient):
 
         Outdated and unused due to Flask using gevent. It's just easier to access the database directy.
         """
-        self.init_db()
-        out = self.db_conn.execute(
-            "select * from depots where app_id=? and is_dlc=0", (app_id,)
-        ).fetchall()
+        with connection() as conn:
+            out = conn.execute(
+                "select * from depots where app_id=? and is_dlc=0", (app_id,)
+            ).fetchall()
 
         return out
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Steamer's Steam client.")
+    commands = parser.add_subparsers(dest="command")
+
+    verify_parser = commands.add_parser(
+        "verify", help="Check an installed app against its manifests"
+    )
+    verify_parser.add_argument("app_id", type=int)
+    verify_parser.add_argument(
+        "--workers", type=int, default=None, help="Hashing processes (default: one per core)"
+    )
+    verify_parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Only report, don't record the results for the next download",
+    )
+    verify_parser.add_argument(
+        "--json", action="store_true", help="Print the report as JSON on the last line"
+    )
+    args = parser.parse_args()
+
     client = LocalSteamClient()
+
+    if args.command == "verify":
+        report = client.verify_app(
+            args.app_id, workers=args.workers, update=not args.no_journal
+        )
+        if args.json:
+            print(json.dumps(report))
+        elif report["error"]:
+            print(report["error"])
+        else:
+            for bad in report["bad"]:
+                print(
+                    "Depot {depot_id}: {filename} at {offset} is {reason}".format(**bad)
+                )
+            print(
+                "Checked {} chunks ({} files, {} depots) in {}s; {} bad.".format(
+                    report["chunks"],
+                    report["files"],
+                    report["depots"],
+                    report["seconds"],
+                    len(report["bad"]),
+                )
+            )
+
+        if report["error"]:
+            sys.exit(1)
@@ -0,0 +1,66 @@
+from gevent.event import AsyncResult
+
+
+class ChunkIndex:
+    """
+    Class used for downloading each unique chunk of an app only once.
+
+    Steam manifests reference the same chunk sha from several files, and sometimes from several depots of the
+    same app. The index remembers where each sha shows up first. That occurrence is fetched from the cdn, and every
+    other occurrence waits for it to land on disk and copies it from there.
+    """
+
+    def __init__(self):
+        """
+        Constructor method. Sets up an empty index.
+        """
+        self.first = {}
+        self.sources = {}
+        self.repeat_bytes = 0
+        self.saved_bytes = 0
+
+    def add_manifest(self, manifest):
+        """
+        Class method. Adds the chunks of a manifest to the index. Manifests have to be added in the order they
+        are going to be downloaded.
+        """
+        for file in manifest.iter_files():
+            for chunk in file.chunks:
+                location = (manifest.depot_id, file.filename, chunk.offset)
+                if self.first.setdefault(chunk.sha, location) != location:
+                    self.repeat_bytes += chunk.cb_compressed
+
+    def is_first(self, depot_id, filename, chunk):
+        """
+        Class method. Returns True if this is the occurrence of the chunk that gets fetched from the cdn.
+        Chunks that aren't in the index at all are treated as first occurrences.
+        """
+        location = (depot_id, filename, chunk.offset)
+        return self.first.get(chunk.sha, location) == location
+
+    def source(self, sha):
+        """
+        Class method. Returns the AsyncResult that resolves to `(path, offset)` once the chunk is on disk,
+        or to None if fetching it failed.
+        """
+        if sha not in self.sources:
+            self.sources[sha] = AsyncResult()
+
+        return self.sources[sha]
+
+    def publish(self, sha, path, offset: int):
+        """
+        Class method. Marks the chunk as available on disk at `path`, `offset`.
+        """
+        result = self.source(sha)
+        if not result.ready() or result.value is None:
+            result.set((path, offset))
+
+    def fail(self, sha):
+        """
+        Class method. Wakes up anything waiting on a chunk that could not be fetched. Does nothing if the chunk
+        is already available.
+        """
+        result = self.source(sha)
+        if not result.ready():
+            result.set(None)
@@ -0,0 +1,148 @@
+from db import connection
+from steam.client.cdn import CDNDepotManifest
+
+# Suffix for the new version of a changed file while an update is being built next to the old one
+STAGING_SUFFIX = ".steamer-update"
+
+
+class InstalledManifests:
+    """
+    Class keeping the manifest each depot was last fully downloaded with, per install directory.
+    This is what updates get diffed against.
+    """
+
+    def __init__(self):
+        """
+        Constructor method. Makes sure the table exists.
+        """
+        with connection() as conn:
+            conn.execute(
+                """
+                create table if not exists installed_depots (
+                    depot_id number,
+                    app_id number,
+                    install_dir text,
+                    manifest_gid text,
+                    manifest blob,
+                    primary key (depot_id, install_dir)
+                )
+            """
+            )
+
+    def get(self, cdn, app_id: int, depot_id: int, install_dir):
+        """
+        Class method. Returns the installed manifest for a depot in `install_dir`, or None if the depot
+        was never fully downloaded there.
+        """
+        with connection() as conn:
+            row = conn.execute(
+                "select manifest from installed_depots where depot_id=? and install_dir=?",
+                (int(depot_id), str(install_dir)),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return CDNDepotManifest(cdn, app_id, row[0])
+
+    def record(self, manifest, install_dir):
+        """
+        Class method. Marks `manifest` as the version of its depot now installed in `install_dir`.
+        """
+        with connection() as conn:
+            conn.execute(
+                "insert or replace into installed_depots VALUES(?, ?, ?, ?, ?)",
+                (
+                    int(manifest.depot_id),
+                    int(manifest.app_id),
+                    str(install_dir),
+                    str(manifest.gid),
+                    manifest.serialize(),
+                ),
+            )
+
+
+class ManifestDiff:
+    """
+    Class describing the difference between the installed manifest of a depot and the one being downloaded.
+
+    Files whose chunk lists didn't change are left alone. Chunks of changed files that already exist somewhere
+    in the old version are copied from there, and only chunks that are new to the depot are fetched. Files
+    that are gone from the new version are listed in `removed`; they may have moved to another depot of the
+    app, so the caller decides what to delete.
+    """
+
+    def __init__(self, old, new):
+        """
+        Constructor method. Compares the two manifests.
+        """
+        self.old_gid = old.gid
+        self.new_gid = new.gid
+
+        old_files = {}
+        self.old_locations = {}
+        for file in old.iter_files():
+            old_files[file.filename] = file
+            for chunk in file.chunks:
+                self.old_locations.setdefault(chunk.sha, (file.filename, chunk.offset))
+
+        self.old_chunks = {
+            name: {chunk.offset: chunk.sha for chunk in file.chunks}
+            for name, file in old_files.items()
+        }
+
+        self.unchanged = set()
+        self.changed = set()
+        self.fetch_bytes = 0
+        self.local_bytes = 0
+        new_names = set()
+        for file in new.iter_files():
+            new_names.add(file.filename)
+            old_file = old_files.get(file.filename)
+            if old_file is not None:
+                if self.chunk_list(old_file) == self.chunk_list(file):
+                    self.unchanged.add(file.filename)
+                    continue
+
+                self.changed.add(file.filename)
+
+            for chunk in file.chunks:
+                if chunk.sha in self.old_locations:
+                    self.local_bytes += chunk.cb_original
+                else:
+                    self.fetch_bytes += chunk.cb_compressed
+
+        self.removed = sorted(
+            (f for f in old_files.values() if f.filename not in new_names),
+            key=lambda f: f.filename,
+            reverse=True,  # Files before the directories that hold them
+        )
+
+    @staticmethod
+    def chunk_list(file):
+        """
+        Static method. The parts of a file entry that decide whether it has to be rebuilt.
+        """
+        return (file.size, sorted((c.offset, c.sha) for c in file.chunks))
+
+    def is_unchanged(self, file):
+        """
+        Class method. Returns True if the file is identical in both versions.
+        """
+        return file.filename in self.unchanged
+
+    def is_changed(self, file):
+        """
+        Class method. Returns True if the file exists in both versions with different contents.
+        """
+        return file.filename in self.changed
+
+    def local_source(self, file, chunk):
+        """
+        Class method. Returns `(filename, offset)` of a copy of the chunk in the old version, preferring the
+        same spot in the same file, or None if the chunk is new.
+        """
+        if self.old_chunks.get(file.filename, {}).get(chunk.offset) == chunk.sha:
+            return (file.filename, chunk.offset)
+
+        return self.old_locations.get(chunk.sha)
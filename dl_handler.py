@@ -3,47 +3,86 @@ from pathlib import Path
 from steam.core.crypto import sha1_hash
 from timelimits import TimeRange
 from utils import human_readable
+from writer import (
+    FileWriter,
+    WriteBuffer,
+    DEFAULT_WRITE_BUFFER_SIZE,
+    DEFAULT_FSYNC_POLICY,
+)
+from journal import ChunkJournal
+from dedup import ChunkIndex
+from delta import InstalledManifests, ManifestDiff, STAGING_SUFFIX
+from ratelimit import bandwidth_limiter
+from progress import DownloadProgress, download_states
+import metrics
+from logs import logger, ChunkLogSummary
+
+from gevent import spawn, spawn_later
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+import os
+import time
+import logging
 
-from gevent.socket import wait_read, wait_write
-from gevent import sleep
+# Number of chunk requests kept in flight per depot when nothing is set in `settings.json`
+DEFAULT_CHUNK_CONCURRENCY = 8
 
-import logging
+# Seconds before a download that ended with failed chunks is tried again
+RETRY_DELAY = 300
 
-logging.basicConfig(
-    format="[%(asctime)s] === %(levelname)s === %(message)s",
-    datefmt="%m/%d/%Y - %I:%M:%S",
-    filename="log.txt",
-    encoding="utf-8",
-    level=logging.INFO,
-)
-logger = logging
+# Seconds between checks for a stop while the last chunks of a depot land
+HALT_CHECK_INTERVAL = 0.5
 
 
 class ManifestProcess:
     """
     Class used for wrapping the steam manifest download process.
+
+    Commands arrive on a gevent queue (see `send`) and are handled by `run` as soon as they are put there.
+    The download itself runs in its own greenlet, which only has to look at `self.downloading` to know when
+    to stop. Time window boundaries are handled by a timer scheduled for the next transition.
+
+    The state of the process is pushed to `progress.download_states` after every command, and about once
+    a second while chunks are landing.
     """
 
     def __init__(
         self,
-        pipe,
         cdn,
         download_path,
         timerange=TimeRange(0, 0, 0, 0),
         depot_whitelist=None,
+        chunk_concurrency=DEFAULT_CHUNK_CONCURRENCY,
+        scheduler=None,
+        write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+        fsync_policy=DEFAULT_FSYNC_POLICY,
     ):
         """
         Constructor method. Sets up the class object
         """
-        self.pipe = pipe
+        self.commands = Queue()
         self.cdn = cdn
         self.download_path = download_path
         self.downloading = False
+        self.stopped = False
         self.alive = True
+        self.worker = None
+        self.window_timer = None
+        self.retry_timer = None
+        self.restarting = False
+        self.failed = False
+        self.scheduler = scheduler
         self.time_range = timerange
         self.target_app = None
         self.filter_func = None
         self.depot_id_whitelist = depot_whitelist
+        self.chunk_concurrency = max(1, int(chunk_concurrency))
+        self.chunk_index = ChunkIndex()
+        self.write_buffer = WriteBuffer(write_buffer_size, fsync_policy)
+        self.chunk_failures = 0
+        self.chunk_log = ChunkLogSummary("[None]")
+        self.progress = DownloadProgress()
         logger.info("Manifest Process object created")
 
     def download_app(self, app_id: int):
@@ -52,13 +91,61 @@ class ManifestProcess:
         """
         print("Working on app: {}".format(app_id))
         logger.info("Working on app: %s", app_id)
-        if self.time_range.inside_window():
-            self.downloading = True
+        self.failed = False
+        started = False
+        completed = False
+        try:
+            if not self.time_range.inside_window():
+                logger.warning("Process manager is outside of time window")
+                return
+
             logger.info("Process is inside window, continuing")
-        else:
-            logger.warn("Process manager is outside of time window")
-            return
 
+            # Wait for the scheduler to let us through
+            if self.scheduler is not None and not self.scheduler.acquire(self):
+                logger.info("[%s] Stopped while waiting for a download slot", app_id)
+                return
+
+            started = True
+            try:
+                completed = self.download_depots(app_id)
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.release(self)
+        finally:
+            self.worker_exited(app_id, started and not completed and self.downloading)
+
+        if completed:
+            logger.info("[%s] Every depot is downloaded", app_id)
+            if self.scheduler is not None:
+                self.scheduler.finish(self)
+
+    def worker_exited(self, app_id, failed: bool):
+        """
+        Class method. Called however the download greenlet ends, so its state never shows a download that
+        isn't running. A download that `failed` (chunks that couldn't be fetched, an error) without being
+        told to stop stays queued, and is tried again after `RETRY_DELAY` seconds.
+        """
+        self.downloading = False
+        self.failed = failed
+        if failed and self.alive:
+            logger.warning(
+                "[%s] Download ended with %s failed chunks, trying again in %ss",
+                app_id,
+                self.chunk_failures,
+                RETRY_DELAY,
+            )
+            if self.retry_timer is not None:
+                self.retry_timer.kill(block=False)
+            self.retry_timer = spawn_later(RETRY_DELAY, self.send, "retry")
+
+        self.publish()
+
+    def download_depots(self, app_id: int):
+        """
+        Class method. Gets the manifests of an app from the cdn and downloads each depot.
+        Returns True if every depot is complete on disk.
+        """
         # Get the manifest from the cdn
         print(self.cdn.steam.logged_on)
         if not self.cdn.steam.logged_on:
@@ -85,145 +172,583 @@ class ManifestProcess:
         manifests = self.cdn.get_manifests(int(app_id), filter_func=self.filter_func)
         logger.info("[%s]: Manifests: %s", self.target_app, manifests)
 
+        # Index every chunk of the app up front so repeated chunks are only fetched once
+        self.chunk_index = ChunkIndex()
+        for man in manifests:
+            self.chunk_index.add_manifest(man)
+        logger.info(
+            "[%s] %s of chunks are repeats and can be copied locally",
+            self.target_app,
+            human_readable(self.chunk_index.repeat_bytes),
+        )
+
+        self.progress.reset()
+        for man in manifests:
+            self.progress.add_depot(
+                man.depot_id, sum(file.size for file in man.iter_files())
+            )
+        self.publish()
+
+        installed = InstalledManifests()
+        install_dir = Path(self.download_path).resolve()
+        # Every depot installs into the same directory, so a file dropped from one depot may have moved to another
+        new_names = {file.filename for man in manifests for file in man.iter_files()}
+        removed = []
+        completed = True
         for man in manifests:
             logger.info("[%s] Working on depot %s", self.target_app, man.name)
             print(man.name)
-            if self.downloading:
-                self.handle_manifest(man)
+            if not self.downloading:
+                completed = False
+                continue
+
+            # If an older version of the depot is installed, only apply the difference
+            diff = None
+            old = installed.get(self.cdn, man.app_id, man.depot_id, install_dir)
+            if old is not None and old.gid != man.gid:
+                diff = ManifestDiff(old, man)
+                logger.info(
+                    "[%s] Updating depot %s from manifest %s to %s: %s to fetch, %s to copy locally, %s files to remove",
+                    self.target_app,
+                    man.depot_id,
+                    old.gid,
+                    man.gid,
+                    human_readable(diff.fetch_bytes),
+                    human_readable(diff.local_bytes),
+                    len(diff.removed),
+                )
+
+            if self.handle_manifest(man, diff=diff):
+                installed.record(man, install_dir)
+                if diff is not None:
+                    removed.extend(diff.removed)
+            else:
+                completed = False
+
+        # Only once no depot is writing any more, and only what no new manifest still has
+        self.remove_files(install_dir, removed, new_names)
+
+        logger.info(
+            "[%s] Saved %s by copying repeated chunks",
+            self.target_app,
+            human_readable(self.chunk_index.saved_bytes),
+        )
+
+        return completed
+
+    def state(self):
+        """
+        Class method. Returns what the process is doing and how far it has got, as a dictionary.
+        """
+        out = self.progress.state()
+        out["app_id"] = None if self.target_app is None else int(self.target_app)
+        out["downloading"] = self.downloading
+        out["stopped"] = self.stopped
+        out["failed"] = self.failed
+        out["failed_chunks"] = self.chunk_failures
+        out["profiling"] = metrics.profiler.is_enabled(self)
+
+        return out
+
+    def set_profiling(self, enabled: bool):
+        """
+        Class method. Turns the sampling profiler on or off for this process. See `metrics.SamplingProfiler`.
+        Returns the folded stacks collected so far.
+        """
+        folded = metrics.profiler.folded(self)
+        if enabled:
+            metrics.profiler.enable(self)
+        else:
+            metrics.profiler.disable(self)
 
-    def pump_messages(self):
+        return folded
+
+    def publish(self):
+        """
+        Class method. Pushes the state of the process to `download_states`, where the web side reads it.
         """
-        Class method. Because the download process exists within a gevent Greenlet, we can poll it with Pipes.
+        if self.alive and self.target_app is not None:
+            download_states.update(self.target_app, self.state())
+
+    def send(self, msg):
+        """
+        Class method. Queues a command for the process.
 
         Commands:
-            - 'stop' -> Stop the process from downloading.
-            - 'start' -> Start the process downloading.
+            - 'stop' -> Stop the process from downloading until it gets a 'start'.
+            - 'start' -> Let the process download again.
             - 'download' -> Tuple message; msg[1] is the app id to download.
+            - 'window' -> Sent by the window timer when the time window opens or closes.
+            - 'retry' -> Sent by the retry timer after a download failed; starts it again if nothing stopped it.
+            - 'quit' -> Stop downloading and end the process.
+        """
+        self.commands.put(msg)
+
+    def run(self):
+        """
+        Class method. Body of the process greenlet. Handles commands until the process is told to quit.
+        """
+        self.schedule_window_timer()
+
+        while self.alive:
+            self.handle_message(self.commands.get())
+
+    def handle_message(self, msg):
+        """
+        Class method. Acts on a single command; see `send` for the list.
+        """
+        logger.info("[%s]: Received message: `%s`", self.target_app, msg)
+        start = time.perf_counter()
+        try:
+            self.dispatch_message(msg)
+        finally:
+            metrics.command_seconds.observe(time.perf_counter() - start)
+
+    def dispatch_message(self, msg):
+        """
+        Class method. Does the work of `handle_message`.
+        """
+        if msg == "stop":
+            self.stopped = True
+            self.halt()
+        elif msg == "start":
+            self.stopped = False
+            self.start_download()
+        elif msg == "retry":
+            self.start_download()
+        elif msg == "window":
+            if self.time_range.inside_window():
+                self.start_download()
+            else:
+                # If leaving the window
+                self.halt()
+            self.schedule_window_timer()
+        elif msg == "quit":
+            self.alive = False
+            self.halt()
+            if self.window_timer is not None:
+                self.window_timer.kill(block=False)
+            if self.retry_timer is not None:
+                self.retry_timer.kill(block=False)
+            metrics.profiler.disable(self)
+            download_states.remove(self.target_app)
+            return
+        elif msg[0] == "download":
+            self.target_app = msg[1]
+            self.start_download()
+
+        self.publish()
+
+    def halt(self):
+        """
+        Class method. Tells the download greenlet to stop, including when it is still waiting for a slot.
+        """
+        self.downloading = False
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
+
+    def start_download(self):
+        """
+        Class method. Starts the download greenlet if there is an app to download, the process hasn't been
+        stopped, and we are inside the time window.
+        """
+        if self.target_app is None or self.stopped:
+            return
 
-        Note: While pumping messages, the system will begin downloading if it gets within the time window.
-        """
-        # Poll the pipe for new info
-        while self.pipe.poll():
-            wait_read(self.pipe.fileno())
-            msg = self.pipe.recv()
-            logger.info("[%s]: Received message: `%s`", self.target_app, msg)
-
-            if msg == "stop":
-                self.downloading = False
-            elif msg == "start":
-                self.downloading = True
-            elif msg[0] == "download":
-                self.target_app = msg[1]
-                self.download_app(msg[1])
-
-            elif msg == "query":
-                wait_write(self.pipe.fileno())
-                self.pipe.send(self.downloading)
-
-        # if entering the window
-        if self.time_range.inside_window() and not self.downloading:
-            # Run the downloader
-            self.downloading = True
-            self.download_app(self.target_app)
-
-        # If leaving the windoe
         if not self.time_range.inside_window():
-            self.downloading = False
+            return
+
+        if self.worker is not None and not self.worker.dead:
+            if self.downloading or self.restarting:
+                return
+
+            # Still winding down from a stop. Start over once it is done, without holding up the other commands.
+            self.restarting = True
+            self.worker = spawn(self.restart_download, self.worker, self.target_app)
+            return
+
+        self.downloading = True
+        self.worker = spawn(self.download_app, self.target_app)
 
-    def handle_manifest(self, manifest):
+    def restart_download(self, previous, app_id):
+        """
+        Class method. Body of a download greenlet that first waits for `previous` to wind down. Only starts if
+        nothing stopped the process or closed the window meanwhile.
+        """
+        try:
+            previous.join()
+        finally:
+            self.restarting = False
+
+        if not self.alive or self.stopped or not self.time_range.inside_window():
+            return
+
+        self.downloading = True
+        self.download_app(app_id)
+
+    def schedule_window_timer(self):
+        """
+        Class method. Arranges for a 'window' command to be sent when the time window next opens or closes.
+        """
+        if self.window_timer is not None:
+            self.window_timer.kill(block=False)
+
+        self.window_timer = spawn_later(
+            self.time_range.seconds_until_change(), self.send, "window"
+        )
+
+    def handle_manifest(self, manifest, diff=None):
         """
         Class method. Given a manifest, downloading the files from the steam sever.
+        Returns True if every file of the depot is complete on disk.
+
+        Chunks are fetched through a bounded gevent pool, so up to `self.chunk_concurrency` requests
+        are in flight for the depot at once. Chunks already on disk are checked in this greenlet before
+        anything is handed to the pool; chunks the journal knows are finished are skipped without reading them.
+
+        When `diff` (a `ManifestDiff` against the installed version) is given, unchanged files are skipped
+        outright and changed files are rebuilt next to the old ones from local copies where possible. The
+        new files replace the old ones only once the whole depot is done. Removed files are left to
+        `download_depots`, which deletes them after every depot of the app.
         """
         base_path = Path(self.download_path)
+        pool = Pool(self.chunk_concurrency)
+        open_writers = []
+        staged = []
+        journal = ChunkJournal(manifest.depot_id, manifest.gid)
+        self.chunk_failures = 0
+        self.chunk_log = ChunkLogSummary(
+            "[{}] Depot {}:".format(self.target_app, manifest.depot_id)
+        )
+        # Per chunk lines cost a sha.hex() and a queued record each, so only build them when asked for
+        trace = logger.isEnabledFor(logging.DEBUG)
+
+        def halt():
+            # Kill whatever is in flight and let go of the file handles
+            pool.kill()
+            for w in open_writers:
+                w.close()
+            journal.close()
+            self.chunk_log.flush()
 
         # Grab the file iterator
         file_list_iterator = manifest.iter_files()
 
         for file in file_list_iterator:
-            total_bytes = 0
-            logger.info("[%s] Getting file %s", self.target_app, file)
-
-            # Check if there are any messages in the pipe
-            self.pump_messages()
+            if trace:
+                logger.debug("[%s] Getting file %s", self.target_app, file)
 
             # Check for the stop condition
             if not self.downloading:
                 logger.info("[%s] (File) Downloading was halted.", self.target_app)
-                return
+                halt()
+                return False
 
             # Build the file path
             fp = base_path / file.filename
 
-            # Check if the file exists
-            if not fp.exists():
-                # Create the file if it does not
-                Path(fp.parents[0]).mkdir(parents=True, exist_ok=True)
+            if file.is_directory:
+                fp.mkdir(parents=True, exist_ok=True)
+                continue
+
+            # Make sure the folder the file lives in exists
+            Path(fp.parents[0]).mkdir(parents=True, exist_ok=True)
+
+            target = fp
+            if diff is not None and fp.exists():
+                if diff.is_unchanged(file):
+                    for chunk in file.chunks:
+                        self.chunk_index.publish(chunk.sha, fp, chunk.offset)
+                    self.progress.skip(manifest.depot_id, file.size)
+                    continue
+
+                if diff.is_changed(file):
+                    # Build the new version beside the old one, which may still be copied from
+                    target = fp.with_name(fp.name + STAGING_SUFFIX)
+                    staged.append((target, fp))
+
+            # Throw out the journal entries of files that were touched since they were recorded,
+            # and skip files that were finished and left alone since
+            if journal.check_file(file.filename, target):
+                for chunk in file.chunks:
+                    self.chunk_index.publish(chunk.sha, target, chunk.offset)
+                self.progress.skip(manifest.depot_id, file.size)
+                self.chunk_log.note("in finished files", file.size)
+                continue
+
+            # One handle for the whole file, closed when its last chunk is written
+            writer = FileWriter(
+                target,
+                file.size,
+                on_close=lambda w, f=file: journal.stamp_file(
+                    f.filename, w.path, journal.is_complete(f.filename, f.chunks)
+                ),
+                buffer=self.write_buffer,
+            )
+            open_writers[:] = [w for w in open_writers if not w.closed]
+            open_writers.append(writer)
 
             # Read the chunks from the file and iterate over them.
             for chunk in file.chunks:
-                # Pump messages after each chunk to improve responsiveness when downloading large files
-                self.pump_messages()
-
+                # `downloading` is flipped by `handle_message` the moment a stop or window close comes in
                 if not self.downloading:
                     logger.info("[%s] (Chunk) Downloading was halted.", self.target_app)
-                    return
-
-                # Verify the sha1 hash of the file
-                try:
-                    with open(fp, "rb") as f:
-                        # Ensure we are seeking over actual data, as in the offset does not exceed the filesize
-                        # because that's undefined behavior in python! For some reason.
-                        max_offset = f.seek(
-                            0, 2
-                        )  # Read the 0th byte from the end of the file
-                        f.seek(0)
-
-                        if chunk.offset < max_offset:
-                            f.seek(chunk.offset)
-                            cur_data = f.read(chunk.cb_original)
-                            if sha1_hash(cur_data) == chunk.sha:
-                                # if the two are the same, we have the entire chunk!
-                                total_bytes += chunk.cb_original
-                                logger.info(
-                                    "[%s] Chunk `%s` has the same hash as disk, skipping. . .",
-                                    self.target_app,
-                                    chunk.sha.hex(),
-                                )
-                                continue
-
-                except FileNotFoundError:
-                    # Create the file if it does not exist
-                    with open(fp, "wb"):
-                        pass
-
-                # get the chunk data from the cdn
-                data = self.cdn.get_chunk(
-                    manifest.app_id, manifest.depot_id, chunk.sha.hex()
-                )
-                logger.info(
-                    "[%s] Got data for chunk `%s` from server (%s of %s bytes)",
-                    self.target_app,
-                    chunk.sha.hex(),
-                    human_readable(total_bytes),
-                    human_readable(file.size),
+                    halt()
+                    return False
+
+                if journal.is_done(file.filename, chunk):
+                    self.chunk_index.publish(chunk.sha, target, chunk.offset)
+                    self.progress.skip(manifest.depot_id, chunk.cb_original)
+                    self.chunk_log.note("already done", chunk.cb_original)
+                    continue
+
+                local = None
+                if diff is not None:
+                    local = diff.local_source(file, chunk)
+                    # A file missing from disk can't be its own source
+                    if local is not None and base_path / local[0] != target:
+                        local = (base_path / local[0], local[1])
+                    else:
+                        local = None
+
+                # Verify the sha1 hash of the data already on disk. Updates trust the installed manifest instead.
+                elif self.verify_chunk(writer, chunk):
+                    # if the two are the same, we have the entire chunk!
+                    if trace:
+                        logger.debug(
+                            "[%s] Chunk `%s` has the same hash as disk, skipping. . .",
+                            self.target_app,
+                            chunk.sha.hex(),
+                        )
+                    journal.mark_done(file.filename, chunk)
+                    self.chunk_index.publish(chunk.sha, fp, chunk.offset)
+                    self.progress.skip(manifest.depot_id, chunk.cb_original)
+                    self.chunk_log.note("verified on disk", chunk.cb_original)
+                    continue
+
+                # Blocks while the pool is full, which keeps at most `chunk_concurrency` requests in flight
+                writer.acquire()
+                pool.spawn(
+                    self.process_chunk, manifest, file, chunk, writer, journal, local
                 )
 
-                # Write the data to the file
-                with open(fp, "r+b") as f:
-                    f.seek(chunk.offset)
-                    f.write(data)
+            # Drop the reference held while queueing chunks
+            writer.release()
+
+        # Let the last requests of the depot land before moving on, unless told to stop meanwhile
+        while len(pool):
+            if not self.downloading:
+                logger.info("[%s] (Depot) Downloading was halted.", self.target_app)
+                halt()
+                return False
+
+            pool.join(timeout=HALT_CHECK_INTERVAL)
+        journal.close()
+        self.chunk_log.flush()
 
-                total_bytes += chunk.cb_original
+        completed = self.downloading and self.chunk_failures == 0
+        if completed and diff is not None:
+            self.finish_update(staged)
 
+        return completed
 
-def manifest_process_factory(*args, **kwargs):
-    """
-    Wrapper function used to create a new process. *args and **kwargs are passed directly into
-    the ManifestProcess constructor. It will then sleep and pump the messages for the process until
-    something occurs it needs to handle.
-    """
-    p = ManifestProcess(*args, **kwargs)
+    def verify_chunk(self, writer, chunk):
+        """
+        Class method. Returns True if the data at the chunk's offset already has the chunk's sha1.
+        Ranges the file didn't reach before it was preallocated are only zeros, and aren't read.
+        """
+        if not writer.existed(chunk.offset, chunk.cb_original):
+            return False
+
+        start = time.perf_counter()
+        matches = sha1_hash(writer.read(chunk.offset, chunk.cb_original)) == chunk.sha
+        metrics.chunk_verify_seconds.observe(time.perf_counter() - start)
+
+        return matches
+
+    def finish_update(self, staged):
+        """
+        Class method. Swaps the rebuilt files of an update in over the old ones.
+        """
+        for new_path, old_path in staged:
+            os.replace(new_path, old_path)
+
+        logger.info("[%s] Update applied: %s files replaced", self.target_app, len(staged))
+
+    def remove_files(self, base_path, removed, keep):
+        """
+        Class method. Deletes the files and directories in `removed` (manifest entries of updated depots), except
+        those whose filename is in `keep`, i.e. still part of one of the app's new manifests.
+        """
+        entries = {}
+        for file in removed:
+            if file.filename not in keep:
+                entries[file.filename] = file
+
+        # Files before the directories that hold them
+        for name in sorted(entries, reverse=True):
+            fp = base_path / name
+            try:
+                if entries[name].is_directory:
+                    fp.rmdir()
+                else:
+                    fp.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Most likely a directory that still holds files the user put there
+                logger.warning("[%s] Could not remove %s: %s", self.target_app, fp, e)
+
+        if entries:
+            logger.info("[%s] Removed %s old files", self.target_app, len(entries))
+
+    def process_chunk(self, manifest, file, chunk, writer, journal, local=None):
+        """
+        Class method. Gets a single chunk onto disk at its offset through `writer`. Runs inside the chunk pool
+        of `handle_manifest`.
+
+        Chunks with a `local` `(path, offset)` copy from the installed version are copied from there. Repeated
+        chunks are copied from wherever their first occurrence was written. Everything else (and any copy that
+        fails) is fetched from the cdn.
+        """
+        first = self.chunk_index.is_first(manifest.depot_id, file.filename, chunk)
+        try:
+            if not self.downloading:
+                return
+
+            # The journal only hears about a chunk once the write buffer has put it on disk
+            def written():
+                journal.mark_done(file.filename, chunk)
+
+            if local is not None and self.copy_local(chunk, writer, *local, written):
+                self.chunk_index.publish(chunk.sha, writer.path, chunk.offset)
+                self.chunk_log.note("copied from the old version", chunk.cb_original)
+                if self.progress.add(manifest.depot_id, chunk.cb_original):
+                    self.publish()
+                return
+
+            if not first and self.copy_chunk(chunk, writer, written):
+                self.chunk_log.note("copied repeats", chunk.cb_original)
+                if self.progress.add(manifest.depot_id, chunk.cb_original):
+                    self.publish()
+                return
+
+            data = self.fetch_chunk(manifest, file, chunk)
+            if data is None:
+                if self.downloading:
+                    self.chunk_failures += 1
+                    self.chunk_log.note("failed", chunk.cb_compressed)
+                return
+
+            # Write the data to the file
+            if not writer.closed:
+                start = time.perf_counter()
+                writer.write(chunk.offset, data, written)
+                metrics.chunk_write_seconds.observe(time.perf_counter() - start)
+                self.chunk_index.publish(chunk.sha, writer.path, chunk.offset)
+                if self.progress.add(
+                    manifest.depot_id, chunk.cb_original, chunk.cb_compressed
+                ):
+                    self.publish()
+        finally:
+            if first:
+                self.chunk_index.fail(chunk.sha)
+            writer.release()
+
+    def fetch_chunk(self, manifest, file, chunk):
+        """
+        Class method. Fetches a single chunk from the cdn.
+
+        Errors are logged and swallowed, returning None; the chunk will be picked up again the next time the
+        depot is processed.
+        """
+        # Wait our turn if the link is capped
+        bandwidth_limiter.consume(chunk.cb_compressed)
+
+        # get the chunk data from the cdn
+        try:
+            data = self.cdn.get_chunk(
+                manifest.app_id, manifest.depot_id, chunk.sha.hex()
+            )
+        except Exception as e:
+            logger.error(
+                "[%s] Failed to get chunk `%s`: %s",
+                self.target_app,
+                chunk.sha.hex(),
+                e,
+            )
+            return None
+
+        metrics.chunks_fetched.inc()
+        metrics.chunk_bytes_fetched.inc(chunk.cb_compressed)
+        self.chunk_log.note("fetched", chunk.cb_compressed)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[%s] Got data for chunk `%s` from server (%s of %s)",
+                self.target_app,
+                chunk.sha.hex(),
+                human_readable(chunk.cb_original),
+                human_readable(file.size),
+            )
+
+        return data
+
+    def copy_local(self, chunk, writer, src_path, src_offset, on_written=None):
+        """
+        Class method. Copies a chunk out of the installed version of the depot. Returns False if that fails.
+        """
+        return self.copy_into(chunk, writer, src_path, src_offset, on_written)
+
+    def copy_chunk(self, chunk, writer, on_written=None):
+        """
+        Class method. Waits for the first occurrence of a repeated chunk to land on disk, then copies it into
+        place. Returns False if the first occurrence could not be fetched or read.
+        """
+        source = self.chunk_index.source(chunk.sha).get()
+        if source is None:
+            return False
+
+        if not self.copy_into(chunk, writer, *source, on_written):
+            return False
+
+        self.chunk_index.saved_bytes += chunk.cb_compressed
+        return True
+
+    def copy_into(self, chunk, writer, src_path, src_offset, on_written=None):
+        """
+        Class method. Copies `chunk` from `src_offset` of `src_path` into place through `writer`, timing it.
+        The copy has to hash to `chunk.sha`; only then is `on_written` (which marks the chunk done in the
+        journal) called, once the copy is on disk. Errors, short sources and mismatches are logged and
+        swallowed, returning False, so the caller fetches the chunk instead.
+        """
+        if writer.closed:
+            return False
+
+        start = time.perf_counter()
+        try:
+            copied = writer.copy_from(
+                src_path, src_offset, chunk.offset, chunk.cb_original, on_written, chunk.sha
+            )
+        except OSError as e:
+            logger.error(
+                "[%s] Failed to copy chunk `%s` from %s: %s",
+                self.target_app,
+                chunk.sha.hex(),
+                src_path,
+                e,
+            )
+            return False
+
+        if not copied:
+            logger.warning(
+                "[%s] Copy of chunk `%s` from %s is short or damaged, fetching it instead",
+                self.target_app,
+                chunk.sha.hex(),
+                src_path,
+            )
+            return False
+
+        metrics.chunk_copy_seconds.observe(time.perf_counter() - start)
+        return True
 
-    while p.alive:
-        sleep(10)
-        p.pump_messages()
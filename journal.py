@@ -0,0 +1,226 @@
+import os
+
+from db import connection
+
+
+class ChunkJournal:
+    """
+    Class keeping track of which chunks of a depot manifest are already on disk, so resuming a download
+    does not have to read and hash data that was finished on a previous night.
+
+    Chunks are recorded per (depot, manifest gid, file, offset) in `steamer.db`. Alongside them, the size,
+    mtime and inode of each file are stamped when its handle is closed, along with whether every chunk of the file
+    was done by then. On resume a file's entries are only trusted if the file still matches its stamp; otherwise
+    they are thrown out and the chunks get hashed like before. Complete files that still match are skipped
+    without looking at their chunks at all.
+    """
+
+    # Number of finished chunks kept in memory before they are written to the database
+    FLUSH_EVERY = 512
+
+    def __init__(self, depot_id: int, manifest_gid):
+        """
+        Constructor method. Loads the journal for the given depot manifest.
+        """
+        self.depot_id = int(depot_id)
+        self.manifest_gid = str(manifest_gid)
+        self.init_db()
+
+        self.done = {}
+        self.stamps = {}
+        self.checked_files = set()
+        self.pending = []
+        self.load()
+
+    def init_db(self):
+        """
+        Class method. Creates the journal tables if they don't exist.
+        """
+        with connection() as conn:
+            conn.execute(
+                """
+                create table if not exists chunk_journal (
+                    depot_id number,
+                    manifest_gid text,
+                    filename text,
+                    chunk_offset number,
+                    sha blob,
+                    primary key (depot_id, manifest_gid, filename, chunk_offset)
+                )
+            """
+            )
+
+            conn.execute(
+                """
+                create table if not exists journal_files (
+                    depot_id number,
+                    manifest_gid text,
+                    filename text,
+                    size number,
+                    mtime_ns number,
+                    inode number,
+                    complete bool,
+                    primary key (depot_id, manifest_gid, filename)
+                )
+            """
+            )
+
+            # Journals from before files were stamped with their inode and completeness
+            columns = [row[1] for row in conn.execute("pragma table_info(journal_files)")]
+            for column, kind in (("inode", "number"), ("complete", "bool")):
+                if column not in columns:
+                    conn.execute(
+                        "alter table journal_files add column {} {}".format(column, kind)
+                    )
+
+    def load(self):
+        """
+        Class method. Reads the journal for this depot manifest into memory. Entries left over from
+        older manifests of the depot are dropped, since they can never match again.
+        """
+        with connection() as conn:
+            for table in ("chunk_journal", "journal_files"):
+                conn.execute(
+                    "delete from {} where depot_id=? and manifest_gid != ?".format(table),
+                    (self.depot_id, self.manifest_gid),
+                )
+
+            rows = conn.execute(
+                "select filename, chunk_offset, sha from chunk_journal where depot_id=? and manifest_gid=?",
+                (self.depot_id, self.manifest_gid),
+            )
+            self.done = {}
+            for filename, offset, sha in rows:
+                self.done.setdefault(filename, {})[offset] = sha
+
+            rows = conn.execute(
+                "select filename, size, mtime_ns, inode, complete from journal_files where depot_id=? and manifest_gid=?",
+                (self.depot_id, self.manifest_gid),
+            )
+            self.stamps = {
+                filename: ((size, mtime_ns, inode), bool(complete))
+                for filename, size, mtime_ns, inode, complete in rows
+            }
+
+    def check_file(self, filename, path):
+        """
+        Class method. Compares the file on disk with the stamp recorded when it was last closed. If they differ
+        (or there is no stamp), every entry for the file is forgotten so its chunks get verified by hash.
+
+        Returns True if the file was complete when stamped and hasn't been touched since, in which case it
+        doesn't need to be opened at all. Only a stat is done, not a single byte is read.
+
+        Must be called before the file is opened for writing.
+        """
+        if filename in self.checked_files:
+            return False
+
+        self.checked_files.add(filename)
+
+        try:
+            current = self.file_stat(path)
+        except FileNotFoundError:
+            current = None
+
+        stamp = self.stamps.get(filename)
+        if current is not None and stamp is not None and stamp[0] == current:
+            return stamp[1]
+
+        self.forget_file(filename)
+        return False
+
+    @staticmethod
+    def file_stat(path):
+        """
+        Static method. The parts of a file's stat a stamp is made of.
+        """
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def forget_file(self, filename):
+        """
+        Class method. Drops every journal entry for a file.
+        """
+        if filename not in self.done and filename not in self.stamps:
+            return
+
+        self.done.pop(filename, None)
+        self.stamps.pop(filename, None)
+        with connection() as conn:
+            conn.execute(
+                "delete from chunk_journal where depot_id=? and manifest_gid=? and filename=?",
+                (self.depot_id, self.manifest_gid, filename),
+            )
+            conn.execute(
+                "delete from journal_files where depot_id=? and manifest_gid=? and filename=?",
+                (self.depot_id, self.manifest_gid, filename),
+            )
+
+    def is_done(self, filename, chunk):
+        """
+        Class method. Returns True if the chunk is recorded as already written to the file.
+        """
+        return self.done.get(filename, {}).get(chunk.offset) == chunk.sha
+
+    def mark_done(self, filename, chunk):
+        """
+        Class method. Records a chunk as written to the file.
+        """
+        self.done.setdefault(filename, {})[chunk.offset] = chunk.sha
+        self.pending.append(
+            (
+                self.depot_id,
+                self.manifest_gid,
+                filename,
+                chunk.offset,
+                chunk.sha,
+            )
+        )
+
+        if len(self.pending) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def stamp_file(self, filename, path, complete=False):
+        """
+        Class method. Records the size, mtime and inode of a file after its handle has been closed. `complete`
+        says every chunk of the file is done.
+        """
+        self.flush()
+
+        try:
+            current = self.file_stat(path)
+        except FileNotFoundError:
+            return
+
+        self.stamps[filename] = (current, bool(complete))
+        with connection() as conn:
+            conn.execute(
+                "insert or replace into journal_files VALUES(?, ?, ?, ?, ?, ?, ?)",
+                (self.depot_id, self.manifest_gid, filename) + current + (bool(complete),),
+            )
+
+    def is_complete(self, filename, chunks):
+        """
+        Class method. Returns True if every one of `chunks` is recorded as done for the file.
+        """
+        done = self.done.get(filename, {})
+        return all(done.get(chunk.offset) == chunk.sha for chunk in chunks)
+
+    def flush(self):
+        """
+        Class method. Writes the pending chunk entries to the database.
+        """
+        if len(self.pending) == 0:
+            return
+
+        pending, self.pending = self.pending, []
+        with connection() as conn:
+            conn.executemany(
+                "insert or replace into chunk_journal VALUES(?, ?, ?, ?, ?)", pending
+            )
+
+    def close(self):
+        """
+        Class method. Flushes whatever is left in the journal.
+        """
+        self.flush()
@@ -0,0 +1,106 @@
+"""
+Small load test for the Steamer web pages.
+
+Hammers `/` and `/app/<app_id>` from several clients at once, optionally while a populate is running, and prints
+latency percentiles for each route. Run it against a server that is already up and logged in:
+
+    python loadtest.py --app-id 440 --clients 8 --seconds 30 --populate
+"""
+import argparse
+import threading
+import time
+import urllib.request
+
+
+def percentile(values, pct):
+    """
+    Function used for picking the `pct` percentile out of a sorted list.
+    """
+    if len(values) == 0:
+        return 0.0
+
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def client(base, routes, deadline, results, lock):
+    """
+    Function used as the body of each client thread. Requests the routes in turn until `deadline`.
+    """
+    i = 0
+    while time.monotonic() < deadline:
+        route = routes[i % len(routes)]
+        i += 1
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base + route, timeout=60) as resp:
+                resp.read()
+            ok = True
+        except Exception:
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000.0
+
+        with lock:
+            results.setdefault(route, []).append((elapsed, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base", default="http://localhost:5000")
+    parser.add_argument("--app-id", required=True, help="App id to use for /app/<app_id>")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument(
+        "--populate",
+        action="store_true",
+        help="Run /api/v1/populate in the background during the test",
+    )
+    args = parser.parse_args()
+
+    routes = ["/", "/app/{}".format(args.app_id)]
+    results = {}
+    lock = threading.Lock()
+
+    if args.populate:
+        threading.Thread(
+            target=lambda: urllib.request.urlopen(
+                args.base + "/api/v1/populate", timeout=3600
+            ).read(),
+            daemon=True,
+        ).start()
+
+    deadline = time.monotonic() + args.seconds
+    threads = [
+        threading.Thread(target=client, args=(args.base, routes, deadline, results, lock))
+        for _ in range(args.clients)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(
+        "{:<20} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "route", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"
+        )
+    )
+    for route in routes:
+        samples = results.get(route, [])
+        times = sorted(t for t, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        print(
+            "{:<20} {:>7} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                route,
+                len(samples),
+                errors,
+                percentile(times, 50),
+                percentile(times, 95),
+                percentile(times, 99),
+                times[-1] if times else 0.0,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
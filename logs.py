@@ -0,0 +1,180 @@
+import logging
+import time
+from logging.handlers import RotatingFileHandler
+
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
+
+from utils import human_readable
+
+# Defaults for the log settings in `settings.json`
+DEFAULT_LOG_FILE = "log.txt"
+DEFAULT_LOG_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_LOG_BACKUPS = 3
+DEFAULT_LOG_LEVEL = "info"
+
+LOG_FORMAT = "[%(asctime)s] === %(levelname)s === %(message)s"
+LOG_DATE_FORMAT = "%m/%d/%Y - %I:%M:%S"
+
+logger = logging.getLogger("steamer")
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Class handing log records to a single worker thread, which formats them and writes them with `target`.
+
+    Logging from a greenlet is then just a queue put. Formatting the message and the blocking file write (and
+    rotation) happen off the event loop, so a slow SD card doesn't hold up the downloads. If the worker falls
+    too far behind, new records are dropped and counted instead of piling up in memory.
+    """
+
+    # Records waiting for the worker before new ones are dropped
+    MAX_PENDING = 10000
+
+    def __init__(self, target):
+        """
+        Constructor method. `target` is the handler that does the actual writing.
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        # A real queue, not gevent's: the worker is an OS thread blocking on it
+        self.queue = get_original("queue", "SimpleQueue")()
+        self.dropped = 0
+        self.pool = ThreadPool(1)
+        self.worker = self.pool.spawn(self.serve)
+
+    def emit(self, record):
+        """
+        Class method. Queues a record for the worker.
+        """
+        if self.queue.qsize() >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+
+        self.queue.put(record)
+
+    def serve(self):
+        """
+        Class method. Body of the worker thread. Writes records until it is handed None.
+        """
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(
+                    logging.makeLogRecord(
+                        {
+                            "name": logger.name,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": "Logging fell behind, dropped %s records",
+                            "args": (dropped,),
+                        }
+                    )
+                )
+
+            self.target.handle(record)
+
+        self.target.close()
+
+    def close(self):
+        """
+        Class method. Writes out what is still queued and stops the worker.
+        """
+        self.queue.put(None)
+        self.worker.get()
+        self.pool.kill()
+        logging.Handler.close(self)
+
+
+handler = None
+handler_config = None
+
+
+def setup_logging(
+    path=DEFAULT_LOG_FILE,
+    max_bytes=DEFAULT_LOG_MAX_BYTES,
+    backups=DEFAULT_LOG_BACKUPS,
+    level=DEFAULT_LOG_LEVEL,
+):
+    """
+    Function used for sending logs to a size rotated file through an `AsyncLogHandler`.
+
+    Steamer's own messages are logged at `level`; everything else (the steam library, ...) only from warnings up.
+    Calling it again with the same arguments does nothing, so it can run every time the settings are loaded.
+    """
+    global handler, handler_config
+
+    config = (str(path), int(max_bytes), int(backups), str(level).lower())
+    if config == handler_config:
+        return
+
+    target = RotatingFileHandler(
+        path, maxBytes=int(max_bytes), backupCount=int(backups), encoding="utf-8"
+    )
+    target.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+
+    root = logging.getLogger()
+    if handler is not None:
+        root.removeHandler(handler)
+        handler.close()
+
+    handler = AsyncLogHandler(target)
+    handler_config = config
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+
+class ChunkLogSummary:
+    """
+    Class rolling per-chunk events up into one log line every `INTERVAL` seconds, instead of a line per chunk.
+    """
+
+    # Seconds between summary lines
+    INTERVAL = 30.0
+
+    def __init__(self, prefix):
+        """
+        Constructor method. `prefix` starts every summary line.
+        """
+        self.prefix = prefix
+        self.counts = {}
+        self.sizes = {}
+        self.started = time.monotonic()
+
+    def note(self, kind, size=0):
+        """
+        Class method. Counts one chunk event of `kind` (fetched, copied, on disk, failed...) of `size` bytes.
+        """
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.sizes[kind] = self.sizes.get(kind, 0) + size
+
+        now = time.monotonic()
+        if now - self.started >= self.INTERVAL:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """
+        Class method. Logs what was counted since the last summary, if anything.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if self.counts:
+            logger.info(
+                "%s Chunks in the last %.0fs: %s",
+                self.prefix,
+                now - self.started,
+                ", ".join(
+                    "{} {} ({})".format(count, kind, human_readable(self.sizes[kind]))
+                    for kind, count in self.counts.items()
+                ),
+            )
+
+        self.counts = {}
+        self.sizes = {}
+        self.started = now
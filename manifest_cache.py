@@ -0,0 +1,84 @@
+import os
+from pathlib import Path
+
+# Defaults for when nothing is set in `settings.json`
+DEFAULT_MANIFEST_CACHE_DIR = "./.manifest_cache"
+DEFAULT_MANIFEST_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class ManifestCache:
+    """
+    Class used for keeping decrypted depot manifests on disk, keyed by depot id and manifest gid.
+
+    A manifest gid never changes its contents, so a cached copy is always good. The cache is trimmed to
+    `max_bytes` by evicting the least recently used manifests; a hit bumps the file's mtime.
+    """
+
+    def __init__(self, directory=DEFAULT_MANIFEST_CACHE_DIR, max_bytes=DEFAULT_MANIFEST_CACHE_SIZE):
+        """
+        Constructor method. Creates the cache directory if needed.
+        """
+        self.directory = Path(directory)
+        self.max_bytes = int(max_bytes)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, depot_id: int, manifest_gid):
+        """
+        Class method. Returns the path a manifest is cached at.
+        """
+        return self.directory / "{}_{}.manifest".format(int(depot_id), manifest_gid)
+
+    def get(self, depot_id: int, manifest_gid):
+        """
+        Class method. Returns the serialized manifest, or None if it isn't cached.
+        """
+        p = self.path_for(depot_id, manifest_gid)
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Mark it as recently used
+        os.utime(p)
+        return data
+
+    def put(self, depot_id: int, manifest_gid, data: bytes):
+        """
+        Class method. Stores a serialized manifest, then trims the cache back under its size limit.
+        """
+        p = self.path_for(depot_id, manifest_gid)
+        tmp = p.with_name(p.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, p)
+
+        self.evict(keep=p)
+
+    def evict(self, keep=None):
+        """
+        Class method. Deletes the least recently used manifests until the cache fits in `max_bytes`.
+        The manifest at `keep` is never evicted.
+        """
+        entries = []
+        total = 0
+        for p in self.directory.glob("*.manifest"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, p))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
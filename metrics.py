@@ -0,0 +1,249 @@
+import signal
+from bisect import bisect_left
+from collections import Counter as Tally
+
+# Upper bounds (seconds) for the timing histograms, from a fast local write up to a stalled request
+TIME_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """
+    Class counting observations into fixed buckets, the way a Prometheus histogram does.
+    Observing is a bisect and two additions, so it can stay on in the chunk hot path.
+    """
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        """
+        Constructor method. Registers the histogram so `render` exposes it.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        registry.append(self)
+
+    def observe(self, value):
+        """
+        Class method. Records one observation.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        """
+        Class method. Returns the histogram in the Prometheus text format.
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.help_text),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, total))
+        total += self.counts[-1]
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, total))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, total))
+
+        return "\n".join(lines)
+
+
+class Counter:
+    """
+    Class holding a number that only goes up.
+    """
+
+    def __init__(self, name, help_text):
+        """
+        Constructor method. Registers the counter so `render` exposes it.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        registry.append(self)
+
+    def inc(self, n=1):
+        """
+        Class method. Adds `n` to the counter.
+        """
+        self.value += n
+
+    def render(self):
+        """
+        Class method. Returns the counter in the Prometheus text format.
+        """
+        return "# HELP {0} {1}\n# TYPE {0} counter\n{0} {2}".format(
+            self.name, self.help_text, self.value
+        )
+
+
+registry = []
+
+
+def render():
+    """
+    Function used for exposing every registered metric in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+chunk_fetch_seconds = Histogram(
+    "steamer_chunk_fetch_seconds", "Time waiting on the cdn for a chunk request."
+)
+chunk_decode_seconds = Histogram(
+    "steamer_chunk_decode_seconds", "Time decrypting and decompressing a chunk."
+)
+chunk_verify_seconds = Histogram(
+    "steamer_chunk_verify_seconds",
+    "Time reading and hashing a chunk already on disk.",
+)
+chunk_write_seconds = Histogram(
+    "steamer_chunk_write_seconds",
+    "Time handing a fetched chunk to its file, including any buffer flush it set off.",
+)
+write_flush_seconds = Histogram(
+    "steamer_write_flush_seconds",
+    "Time writing out the buffered chunks of one file.",
+)
+chunk_copy_seconds = Histogram(
+    "steamer_chunk_copy_seconds",
+    "Time copying a chunk from elsewhere on disk instead of fetching it.",
+)
+command_seconds = Histogram(
+    "steamer_command_seconds",
+    "Time a download process spends handling one command.",
+)
+chunks_fetched = Counter("steamer_chunks_fetched_total", "Chunks fetched from the cdn.")
+chunk_bytes_fetched = Counter(
+    "steamer_chunk_bytes_fetched_total", "Compressed chunk bytes fetched from the cdn."
+)
+cdn_request_errors = Counter(
+    "steamer_cdn_request_errors_total",
+    "Cdn requests that failed or timed out, before any retry on another server.",
+)
+cdn_server_ejections = Counter(
+    "steamer_cdn_server_ejections_total",
+    "Times a content server was taken out of the pool for failing or being slow.",
+)
+hedges_fired = Counter(
+    "steamer_hedges_fired_total",
+    "Chunk requests sent again to another server for being slower than the p95.",
+)
+hedges_won = Counter(
+    "steamer_hedges_won_total", "Hedged chunk requests where the duplicate came back first."
+)
+hedges_skipped = Counter(
+    "steamer_hedges_skipped_total",
+    "Chunk requests that were due a hedge, but the hedge budget was spent.",
+)
+
+
+class SamplingProfiler:
+    """
+    Class sampling the Python stack on a CPU timer, for the download processes that asked for it.
+
+    Every `INTERVAL` seconds of CPU time the stack that is running is looked at. If one of its frames belongs
+    to a profiled ManifestProcess (chunk pool greenlets included), the stack is counted against that process.
+    The counts come out in the folded format flame graph tools read. The timer only runs while at least one
+    process is being profiled, and only where `signal.setitimer` exists.
+    """
+
+    # Seconds of CPU time between samples
+    INTERVAL = 0.005
+
+    # Frames looked at per sample
+    MAX_DEPTH = 64
+
+    def __init__(self):
+        """
+        Constructor method.
+        """
+        self.samples = {}  # id(proc) -> Counter of folded stacks
+        self.previous_handler = None
+
+    @staticmethod
+    def available():
+        """
+        Static method. Returns True if the platform can run the profiler.
+        """
+        return hasattr(signal, "setitimer") and hasattr(signal, "SIGPROF")
+
+    def enable(self, proc):
+        """
+        Class method. Starts counting samples for `proc`.
+        """
+        if not self.available() or id(proc) in self.samples:
+            return False
+
+        if not self.samples:
+            self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.INTERVAL, self.INTERVAL)
+
+        self.samples[id(proc)] = Tally()
+        return True
+
+    def disable(self, proc):
+        """
+        Class method. Stops counting samples for `proc`. Returns what was counted.
+        """
+        samples = self.samples.pop(id(proc), None)
+        if not self.samples and self.previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.previous_handler = None
+
+        return samples
+
+    def is_enabled(self, proc):
+        """
+        Class method. Returns True if `proc` is being profiled.
+        """
+        return id(proc) in self.samples
+
+    def sample(self, signum, frame):
+        """
+        Class method. Signal handler taking one sample.
+        """
+        stack = []
+        owner = None
+        depth = 0
+        while frame is not None and depth < self.MAX_DEPTH:
+            code = frame.f_code
+            stack.append("{}:{}".format(code.co_name, code.co_filename.rsplit("/", 1)[-1]))
+            if owner is None:
+                # Keyed by id, so whatever `self` happens to be never has to be hashed
+                owner = self.samples.get(id(frame.f_locals.get("self")))
+            frame = frame.f_back
+            depth += 1
+
+        if owner is not None:
+            owner[";".join(reversed(stack))] += 1
+
+    def folded(self, proc):
+        """
+        Class method. Returns the samples of `proc` as folded stacks, one `stack count` per line.
+        """
+        samples = self.samples.get(id(proc), Tally())
+        return "".join(
+            "{} {}\n".format(stack, count) for stack, count in samples.most_common()
+        )
+
+
+profiler = SamplingProfiler()
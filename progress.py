@@ -0,0 +1,186 @@
+import math
+import time
+
+from gevent.event import Event
+
+
+class DownloadProgress:
+    """
+    Class keeping count of how far the download of an app has got.
+
+    Counting happens in the chunk hot path, so `add` and `skip` only bump a few integers. The rates are
+    folded into moving averages at most once a second, and whenever `state` is read.
+    """
+
+    # Seconds of history the moving averages mostly remember
+    RATE_WINDOW = 10.0
+
+    # Smallest gap (seconds) between two rate samples
+    SAMPLE_INTERVAL = 1.0
+
+    def __init__(self):
+        """
+        Constructor method.
+        """
+        self.reset()
+
+    def reset(self):
+        """
+        Class method. Forgets everything, ready for a new pass over the app's depots.
+        """
+        now = time.monotonic()
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.network_bytes = 0
+        self.chunks_done = 0
+        self.depots = {}
+        self.started = now
+        self.last_progress = now
+        self.last_sample = now
+        self.sample_bytes = 0
+        self.sample_chunks = 0
+        self.rate = 0.0
+        self.chunk_rate = 0.0
+
+    def add_depot(self, depot_id: int, total: int):
+        """
+        Class method. Registers a depot and its size on disk.
+        """
+        self.depots[depot_id] = [total, 0]
+        self.total_bytes += total
+
+    def skip(self, depot_id: int, n: int):
+        """
+        Class method. Counts `n` bytes that were already on disk. They are done, but don't count towards the rate.
+        """
+        self.depots[depot_id][1] += n
+        self.done_bytes += n
+
+    def add(self, depot_id: int, n: int, network: int = 0):
+        """
+        Class method. Counts a chunk of `n` bytes written to disk, `network` of which came from the cdn.
+        Returns True when the rates were just resampled, which is a good moment to publish them.
+        """
+        self.depots[depot_id][1] += n
+        self.done_bytes += n
+        self.network_bytes += network
+        self.chunks_done += 1
+        self.sample_bytes += n
+        self.sample_chunks += 1
+
+        now = time.monotonic()
+        self.last_progress = now
+        if now - self.last_sample >= self.SAMPLE_INTERVAL:
+            self.sample(now)
+            return True
+
+        return False
+
+    def sample(self, now):
+        """
+        Class method. Folds what was counted since the last sample into the moving averages.
+        """
+        elapsed = now - self.last_sample
+        if elapsed <= 0:
+            return
+
+        # Weight the new sample by how much time it covers, so irregular samples average out right
+        alpha = 1.0 - math.exp(-elapsed / self.RATE_WINDOW)
+        self.rate += alpha * (self.sample_bytes / elapsed - self.rate)
+        self.chunk_rate += alpha * (self.sample_chunks / elapsed - self.chunk_rate)
+
+        self.last_sample = now
+        self.sample_bytes = 0
+        self.sample_chunks = 0
+
+    def eta(self):
+        """
+        Class method. Returns the seconds left at the current rate, or None if nothing is moving.
+        """
+        if self.rate < 1:
+            return None
+
+        return max(0, self.total_bytes - self.done_bytes) / self.rate
+
+    def state(self):
+        """
+        Class method. Returns the counters as a dictionary.
+        """
+        now = time.monotonic()
+        if now - self.last_sample >= self.SAMPLE_INTERVAL:
+            self.sample(now)
+
+        return {
+            "total_bytes": self.total_bytes,
+            "done_bytes": self.done_bytes,
+            "network_bytes": self.network_bytes,
+            "chunks_done": self.chunks_done,
+            "chunks_per_second": round(self.chunk_rate, 2),
+            "bytes_per_second": round(self.rate),
+            "eta_seconds": self.eta(),
+            "idle_seconds": round(now - self.last_progress, 1),
+            "depots": {
+                str(depot_id): {"total_bytes": total, "done_bytes": done}
+                for depot_id, (total, done) in self.depots.items()
+            },
+        }
+
+
+class DownloadStateStore:
+    """
+    Class holding the latest state of every download, as pushed by the ManifestProcess greenlets.
+
+    Readers never talk to the download greenlets. They take a snapshot, and can block on `wait` until something
+    newer is pushed. Every push bumps `version` and wakes all the waiters at once, so any number of listeners
+    costs the downloads nothing.
+    """
+
+    def __init__(self):
+        """
+        Constructor method.
+        """
+        self.states = {}
+        self.version = 0
+        self.changed = Event()
+
+    def update(self, app_id, state):
+        """
+        Class method. Replaces the state of an app.
+        """
+        self.states[app_id] = state
+        self.bump()
+
+    def remove(self, app_id):
+        """
+        Class method. Drops an app that left the download queue.
+        """
+        if self.states.pop(app_id, None) is not None:
+            self.bump()
+
+    def bump(self):
+        """
+        Class method. Wakes everything waiting for a change.
+        """
+        self.version += 1
+        changed = self.changed
+        self.changed = Event()
+        changed.set()
+
+    def snapshot(self):
+        """
+        Class method. Returns the states of all apps as a list.
+        """
+        return list(self.states.values())
+
+    def wait(self, version: int, timeout=None):
+        """
+        Class method. Blocks until the store is newer than `version`, or `timeout` seconds pass.
+        Returns the current version.
+        """
+        if self.version == version:
+            self.changed.wait(timeout)
+
+        return self.version
+
+
+download_states = DownloadStateStore()
@@ -0,0 +1,99 @@
+import time
+
+from gevent import sleep
+from timelimits import TimeRange
+
+
+class TokenBucket:
+    """
+    Class used for capping how fast chunks are pulled from the cdn.
+
+    One bucket is shared by every ManifestProcess greenlet. Fetches take their size in tokens up front and
+    are allowed to push the bucket into debt; the caller then sleeps until the debt is paid back. That way
+    concurrent fetches queue up behind each other and the link is used right up to the cap, never over it.
+
+    The rate can follow a schedule of time windows, e.g. 2 MiB/s during the day and unlimited at night.
+    """
+
+    # How often (seconds) the schedule is checked for a new rate
+    SCHEDULE_CHECK_INTERVAL = 30
+
+    def __init__(self, rate=0):
+        """
+        Constructor method. A `rate` (bytes per second) of 0 means unlimited.
+        """
+        self.schedule = []
+        self.default_rate = rate
+        self.rate = rate
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.last_schedule_check = 0.0
+
+    def set_schedule(self, schedule, default_rate=0):
+        """
+        Class method. Sets the list of `(TimeRange, rate)` windows. The first window the current time falls in
+        decides the rate; outside all of them `default_rate` is used.
+        """
+        self.schedule = schedule
+        self.default_rate = default_rate
+        self.last_schedule_check = 0.0
+        self.update_rate()
+
+    def update_rate(self):
+        """
+        Class method. Picks the rate for the current time from the schedule.
+        """
+        rate = self.default_rate
+        for time_range, window_rate in self.schedule:
+            if time_range.inside_window():
+                rate = window_rate
+                break
+
+        if rate != self.rate:
+            self.rate = rate
+            # Don't carry a burst (or debt) over from the old rate
+            self.tokens = 0.0
+            self.last_refill = time.monotonic()
+
+    def consume(self, n: int):
+        """
+        Class method. Takes `n` bytes worth of tokens, sleeping the calling greenlet if the bucket is in debt.
+        """
+        now = time.monotonic()
+        if now - self.last_schedule_check >= self.SCHEDULE_CHECK_INTERVAL:
+            self.last_schedule_check = now
+            self.update_rate()
+
+        if not self.rate:
+            return
+
+        # Refill, allowing at most a second's worth of burst
+        self.tokens = min(
+            self.tokens + (now - self.last_refill) * self.rate, float(self.rate)
+        )
+        self.last_refill = now
+
+        self.tokens -= n
+        if self.tokens < 0:
+            sleep(-self.tokens / self.rate)
+
+
+def parse_bandwidth_limits(limits):
+    """
+    Function used for turning the `bandwidth_limits` list from `settings.json` into a schedule for `TokenBucket`.
+
+    Each item looks like `{"start": "08:00", "end": "23:00", "rate": 2097152}`, with the rate in bytes per second
+    and 0 meaning unlimited.
+    """
+    schedule = []
+    for item in limits:
+        s_hour, s_min = item["start"].split(":")
+        e_hour, e_min = item["end"].split(":")
+        tr = TimeRange(int(s_hour), int(s_min), int(e_hour), int(e_min))
+        schedule.append((tr, int(item["rate"])))
+
+    return schedule
+
+
+# Shared by every download
+bandwidth_limiter = TokenBucket()
@@ -0,0 +1,230 @@
+from itertools import count
+
+from gevent.event import Event
+
+# Number of apps allowed to download at the same time when nothing is set in `settings.json`
+DEFAULT_MAX_ACTIVE_DOWNLOADS = 1
+
+
+class Job:
+    """
+    Class holding a queued app download and its place in the queue.
+    """
+
+    def __init__(self, proc, app_id: int, priority: int, seq: int):
+        """
+        Constructor method.
+        """
+        self.proc = proc
+        self.app_id = app_id
+        self.priority = priority
+        self.seq = seq
+        self.waiting = False
+        self.running = False
+        self.slot = Event()
+
+
+class DownloadScheduler:
+    """
+    Class owning the download queue.
+
+    Every queued app gets its own ManifestProcess, which still takes care of its time window and commands,
+    but a process has to hold one of `max_active` slots while it downloads. Slots go to waiting processes in
+    queue order: highest priority first, then first come first served. When an app finishes it leaves the
+    queue and its slot goes to the next one in line.
+    """
+
+    def __init__(self, max_active=DEFAULT_MAX_ACTIVE_DOWNLOADS):
+        """
+        Constructor method.
+        """
+        self.max_active = max(1, int(max_active))
+        self.jobs = []
+        self.leaving = []  # Removed jobs whose worker still holds its slot
+        self.seq = count()
+
+    def add(self, proc, app_id: int, priority: int = 0):
+        """
+        Class method. Puts a download in the queue.
+        """
+        job = Job(proc, int(app_id), int(priority), next(self.seq))
+        self.jobs.append(job)
+        self.sort()
+        return job
+
+    def remove(self, app_id: int):
+        """
+        Class method. Takes an app out of the queue and tells its process to quit.
+
+        A download that is running keeps counting against `max_active` until its worker has wound down and
+        calls `release`; only then does the slot go to the next app.
+        """
+        job = self.find(app_id)
+        if job is None:
+            return False
+
+        self.cancel(job.proc)
+        self.jobs.remove(job)
+        if job.running:
+            self.leaving.append(job)
+        job.proc.send("quit")
+        self.promote()
+        return True
+
+    def find(self, app_id: int):
+        """
+        Class method. Returns the job for an app id, or None.
+        """
+        for job in self.jobs:
+            if job.app_id == int(app_id):
+                return job
+
+        return None
+
+    def job_for(self, proc):
+        """
+        Class method. Returns the job for a ManifestProcess, or None.
+        """
+        for job in self.jobs:
+            if job.proc is proc:
+                return job
+
+        return None
+
+    def is_queued(self, app_id: int):
+        """
+        Class method. Returns True if the app is in the queue.
+        """
+        return self.find(app_id) is not None
+
+    def sort(self):
+        """
+        Class method. Puts the queue in slot order.
+        """
+        self.jobs.sort(key=lambda j: (-j.priority, j.seq))
+
+    def set_priority(self, app_id: int, priority: int):
+        """
+        Class method. Changes the priority of a queued app. Running downloads keep their slot.
+        """
+        job = self.find(app_id)
+        if job is None:
+            return False
+
+        job.priority = int(priority)
+        self.sort()
+        self.promote()
+        return True
+
+    def move(self, app_id: int, position: int):
+        """
+        Class method. Moves an app to `position` among the apps of the same priority.
+        """
+        job = self.find(app_id)
+        if job is None:
+            return False
+
+        peers = [j for j in self.jobs if j.priority == job.priority and j is not job]
+        position = max(0, min(int(position), len(peers)))
+        peers.insert(position, job)
+
+        # Hand out fresh sequence numbers in the new order, keeping them below later additions
+        seqs = sorted(j.seq for j in peers)
+        for j, seq in zip(peers, seqs):
+            j.seq = seq
+
+        self.sort()
+        self.promote()
+        return True
+
+    def acquire(self, proc):
+        """
+        Class method. Blocks the calling greenlet until `proc` holds a download slot.
+
+        Returns False if the wait was cancelled (or the process isn't queued) instead.
+        """
+        job = self.job_for(proc)
+        if job is None:
+            return False
+
+        if job.running:
+            return True
+
+        job.waiting = True
+        job.slot.clear()
+        self.promote()
+        job.slot.wait()
+
+        return job.running
+
+    def cancel(self, proc):
+        """
+        Class method. Wakes up `proc` if it is waiting for a slot, without giving it one.
+        """
+        job = self.job_for(proc)
+        if job is not None and job.waiting:
+            job.waiting = False
+            job.slot.set()
+
+    def release(self, proc):
+        """
+        Class method. Gives back the slot `proc` holds, if any, and hands it to the next app in line.
+        """
+        job = self.job_for(proc)
+        for gone in self.leaving:
+            if gone.proc is proc:
+                self.leaving.remove(gone)
+                job = gone
+                break
+
+        if job is not None:
+            job.running = False
+            job.waiting = False
+
+        self.promote()
+
+    def finish(self, proc):
+        """
+        Class method. Called when a process has downloaded everything; its app leaves the queue.
+        """
+        job = self.job_for(proc)
+        if job is None:
+            return
+
+        self.jobs.remove(job)
+        proc.send("quit")
+        self.promote()
+
+    def promote(self):
+        """
+        Class method. Hands free slots to waiting apps in queue order.
+        """
+        active = sum(1 for j in self.jobs if j.running) + len(self.leaving)
+        for job in self.jobs:
+            if active >= self.max_active:
+                break
+
+            if job.waiting:
+                job.waiting = False
+                job.running = True
+                job.slot.set()
+                active += 1
+
+    def state(self):
+        """
+        Class method. Returns the queue as a list of dictionaries, in slot order.
+        """
+        out = []
+        for position, job in enumerate(self.jobs):
+            out.append(
+                {
+                    "app_id": job.app_id,
+                    "position": position,
+                    "priority": job.priority,
+                    "running": job.running,
+                    "waiting": job.waiting,
+                    "downloading": job.proc.downloading,
+                }
+            )
+
+        return out
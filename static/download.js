@@ -32,4 +32,37 @@ $(document).ready(function() {
         $("#steamer-setup-download-submit").prop("disabled", true);
         $("#steamer-setup-download-submit").text("Download queued.");
     });
-});
\ No newline at end of file
+
+    follow_download_progress();
+});
+
+function follow_download_progress() {
+    if (!window.EventSource || $("#steamer-download-progress").length == 0) {
+        return;
+    }
+
+    var app_id = parseInt(window.location.pathname.split('/').reverse()[0]);
+    var source = new EventSource(location.origin + "/api/v1/downloads/stream");
+
+    source.addEventListener("downloads", function(e) {
+        var state = JSON.parse(e.data).find(function(d) { return d.app_id == app_id; });
+        if (state === undefined) {
+            $("#steamer-download-progress").text("");
+            return;
+        }
+
+        var text;
+        if (!state.downloading) {
+            text = state.total_bytes > 0 ? "Paused" : "Waiting for the download window";
+        } else if (state.total_bytes == 0) {
+            text = "Getting manifests. . .";
+        } else {
+            text = (100 * state.done_bytes / state.total_bytes).toFixed(1) + "% done, "
+                + (state.bytes_per_second / 1048576).toFixed(1) + " MiB/s";
+            if (state.eta_seconds !== null) {
+                text += ", about " + Math.ceil(state.eta_seconds / 60) + " minutes left";
+            }
+        }
+        $("#steamer-download-progress").text(text);
+    });
+}
\ No newline at end of file
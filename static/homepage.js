@@ -1,11 +1,96 @@
 $(document).ready(function () {
     $("#steamer-populate-games").click(function() {
+        $("#steamer-populate-games").prop("disabled", true);
+        var progress = setInterval(show_populate_progress, 1000);
+
         $.ajax({
             url: location.origin + "/api/v1/populate",
 
             success: function(data) {
+                clearInterval(progress);
                 location.reload();
             },
         });
     });
-});
\ No newline at end of file
+
+    var search_timer = null;
+    $("#steamer-app-search").on("input", function() {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(function() {
+            $("#steamer-game-table").empty().data("next-cursor", "");
+            load_apps($("#steamer-app-search").val(), null);
+        }, 250);
+    });
+
+    $(window).on("scroll", function() {
+        var cursor = $("#steamer-game-table").data("next-cursor");
+        if (!cursor) {
+            return;
+        }
+
+        if ($(window).scrollTop() + $(window).height() > $(document).height() - 800) {
+            load_apps($("#steamer-app-search").val(), cursor);
+        }
+    });
+});
+
+var apps_loading = null;
+
+function load_apps(q, cursor) {
+    // A new search replaces whatever page was still on its way
+    if (apps_loading !== null) {
+        if (cursor !== null) {
+            return;
+        }
+        apps_loading.abort();
+    }
+
+    var params = {q: q};
+    if (cursor !== null) {
+        params.cursor = cursor;
+    }
+
+    apps_loading = $.ajax({
+        url: location.origin + "/api/v1/apps",
+        data: params,
+
+        success: function(data) {
+            var table = $("#steamer-game-table");
+            $.each(data.data, function(i, app) {
+                var link = $("<a>").attr("href", "/app/" + app.app_id).append(
+                    $("<img>").attr({
+                        loading: "lazy",
+                        src: "https://cdn.cloudflare.steamstatic.com/steamcommunity/public/images/apps/" + app.app_id + "/" + app.logo + ".jpg",
+                    })
+                );
+                table.append(
+                    $("<tr id='steamer-table-row'>").append($("<th>").append(link), $("<th>").text(app.name))
+                );
+            });
+            table.data("next-cursor", data.next_cursor || "");
+        },
+
+        complete: function() {
+            apps_loading = null;
+        },
+    });
+}
+
+function show_populate_progress() {
+    $.ajax({
+        url: location.origin + "/api/v1/populate/progress",
+
+        success: function(data) {
+            if (data.total_apps === undefined) {
+                $("#steamer-populate-progress").text("Asking Steam what changed. . .");
+                return;
+            }
+
+            var text = data.done_apps + " of " + data.total_apps + " apps updated";
+            if (data.failed_batches > 0) {
+                text += " (" + data.failed_batches + " batches failed, try again later)";
+            }
+            $("#steamer-populate-progress").text(text);
+        },
+    });
+}
@@ -46,3 +46,17 @@ class TimeRange:
                 return False
 
         return False  # should never reach this
+
+    def seconds_until_change(self):
+        """
+        Class method. Returns how many seconds until the window next opens or closes.
+
+        The window is inclusive of its end minute, so it closes at the start of the minute after `end_time`.
+        """
+        tn = localtime()
+        now = tn.tm_hour * 3600 + tn.tm_min * 60 + tn.tm_sec
+        opens = self.start_time.hour * 3600 + self.start_time.min * 60
+        closes = (self.end_time.hour * 3600 + self.end_time.min * 60 + 60) % 86400
+
+        # Half a second of slack so we don't wake up just before the minute turns over
+        return min((mark - now) % 86400 or 86400 for mark in (opens, closes)) + 0.5
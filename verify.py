@@ -0,0 +1,214 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from db import connection
+from delta import InstalledManifests
+from journal import ChunkJournal
+
+# Most bytes of chunks handed to a worker process at once. Also the most a worker maps at a time, so big
+# files can be checked on 32 bit boxes too.
+VERIFY_BATCH_BYTES = 64 * 1024 * 1024
+
+
+def hash_ranges(path, ranges):
+    """
+    Function used by the worker processes to check chunks of one file.
+
+    The part of the file holding the chunks is mapped into memory and each chunk is hashed straight out of the
+    mapping, without copying it. `ranges` is a list of `(offset, size, sha)`, sorted by offset.
+
+    Returns: a list of `(offset, reason)` for the chunks that are missing, cut short or don't match.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    except FileNotFoundError:
+        return [(offset, "missing") for offset, _, _ in ranges]
+
+    bad = []
+    try:
+        file_size = os.fstat(fd).st_size
+        start = ranges[0][0] - ranges[0][0] % mmap.ALLOCATIONGRANULARITY
+        end = min(file_size, max(offset + size for offset, size, _ in ranges))
+        if end <= start:
+            return [(offset, "short") for offset, _, _ in ranges]
+
+        with mmap.mmap(
+            fd, end - start, access=mmap.ACCESS_READ, offset=start
+        ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+            view = memoryview(mapped)
+            try:
+                for offset, size, sha in ranges:
+                    if offset + size > file_size:
+                        bad.append((offset, "short"))
+                    elif (
+                        hashlib.sha1(view[offset - start : offset - start + size]).digest()
+                        != sha
+                    ):
+                        bad.append((offset, "mismatch"))
+            finally:
+                view.release()
+    finally:
+        os.close(fd)
+
+    return bad
+
+
+def batches(file):
+    """
+    Function used for splitting the chunks of a manifest file into `(offset, size, sha)` batches for the workers.
+    """
+    batch = []
+    batch_bytes = 0
+    for chunk in sorted(file.chunks, key=lambda c: c.offset):
+        if batch and batch_bytes + chunk.cb_original > VERIFY_BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append((chunk.offset, chunk.cb_original, chunk.sha))
+        batch_bytes += chunk.cb_original
+
+    if batch:
+        yield batch
+
+
+def journal_in_use(depot_id: int, manifest_gid):
+    """
+    Function used for checking whether the chunk journal of a depot belongs to another manifest, i.e. an update
+    is half way through. Opening a ChunkJournal for the installed manifest would throw that progress away.
+    """
+    with connection() as conn:
+        row = conn.execute(
+            "select 1 from chunk_journal where depot_id=? and manifest_gid != ? limit 1",
+            (int(depot_id), str(manifest_gid)),
+        ).fetchone()
+
+    return row is not None
+
+
+def update_journal(manifest, base_path, bad):
+    """
+    Function used for writing what a verify found into the chunk journal of a depot.
+
+    Every chunk that checked out is recorded as done, and the files are stamped as they are now, so the next
+    download of the app trusts them without hashing. Bad chunks are left out, so they are the only ones fetched.
+    """
+    journal = ChunkJournal(manifest.depot_id, manifest.gid)
+    for file in manifest.iter_files():
+        if file.is_directory:
+            continue
+
+        journal.forget_file(file.filename)
+        path = base_path / file.filename
+        if not path.exists():
+            continue
+
+        broken = bad.get(file.filename, set())
+        for chunk in file.chunks:
+            if chunk.offset not in broken:
+                journal.mark_done(file.filename, chunk)
+
+        journal.stamp_file(file.filename, path, complete=not broken)
+
+    journal.close()
+
+
+def verify_install(app_id: int, install_dir, workers=None, update=True):
+    """
+    Function used for checking an installed app against the manifests it was downloaded with.
+
+    Every chunk of every installed depot is hashed, spread over a pool of `workers` processes (one per core by
+    default). With `update`, the chunk journals are brought in line with the results; see `update_journal`.
+
+    Returns: a dictionary with counts and a list of the bad chunks, each with its depot, file, offset and reason.
+    If no depot of the app is recorded as installed in `install_dir`, nothing is checked and `error` says so,
+    rather than reporting a clean pass.
+    """
+    started = time.monotonic()
+    install_dir = Path(install_dir).resolve()
+
+    with connection() as conn:
+        depot_ids = [
+            row[0]
+            for row in conn.execute(
+                "select depot_id from installed_depots where app_id=? and install_dir=?",
+                (int(app_id), str(install_dir)),
+            )
+        ]
+
+    installed = InstalledManifests()
+    manifests = [installed.get(None, app_id, d, install_dir) for d in depot_ids]
+
+    report = {
+        "app_id": int(app_id),
+        "install_dir": str(install_dir),
+        "depots": len(manifests),
+        "files": 0,
+        "chunks": 0,
+        "bytes": 0,
+        "bad": [],
+        "journal_updated": [],
+        "error": None,
+    }
+
+    if not manifests:
+        report["error"] = (
+            "Nothing recorded to verify: no depot of the app was finished in {}".format(install_dir)
+        )
+        report["seconds"] = round(time.monotonic() - started, 2)
+        return report
+
+    # Fork where possible; the workers only need this module, and re-importing the app in each is slow
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {}
+        for manifest in manifests:
+            for file in manifest.iter_files():
+                if file.is_directory:
+                    continue
+
+                report["files"] += 1
+                report["chunks"] += len(file.chunks)
+                report["bytes"] += file.size
+                path = str(install_dir / file.filename)
+                for batch in batches(file):
+                    futures[pool.submit(hash_ranges, path, batch)] = (manifest, file)
+
+        found = {}
+        for future in as_completed(futures):
+            manifest, file = futures[future]
+            for offset, reason in future.result():
+                found.setdefault(manifest.depot_id, {}).setdefault(
+                    file.filename, set()
+                ).add(offset)
+                report["bad"].append(
+                    {
+                        "depot_id": manifest.depot_id,
+                        "filename": file.filename,
+                        "offset": offset,
+                        "reason": reason,
+                    }
+                )
+
+    report["bad"].sort(key=lambda b: (b["depot_id"], b["filename"], b["offset"]))
+
+    if update:
+        for manifest in manifests:
+            if journal_in_use(manifest.depot_id, manifest.gid):
+                continue
+
+            update_journal(manifest, install_dir, found.get(manifest.depot_id, {}))
+            report["journal_updated"].append(manifest.depot_id)
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    return report
@@ -0,0 +1,361 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+from gevent import get_hub
+
+import metrics
+
+# Memory the write-behind buffer of a download may use when nothing is set in `settings.json`. 0 turns it off.
+DEFAULT_WRITE_BUFFER_SIZE = 32 * 1024 * 1024
+
+# When written files are fsynced: "never", "file" (once a file is complete) or "flush" (after every flush)
+DEFAULT_FSYNC_POLICY = "never"
+FSYNC_POLICIES = ("never", "file", "flush")
+
+# Most buffers handed to a single pwritev call
+MAX_IOV = 1024
+
+
+class WriteBuffer:
+    """
+    Class holding chunks that were written to FileWriters but haven't reached the disk yet.
+
+    Chunks come back from the cdn in whatever order the requests finish, so writing each one as it lands makes
+    lots of small scattered writes, which SD cards and USB disks handle badly. Instead chunks wait here, and are
+    written sorted by offset with adjacent ones merged into one big write. A file's chunks are flushed when the
+    file is closed (it is complete, or the download stopped), and when the buffer goes over its memory budget
+    the files holding the most data are flushed until it is back under half of it.
+
+    Anything that reads back a buffered range (repeated chunks being copied, hash checks) gets the data from
+    here instead of the disk.
+    """
+
+    def __init__(self, budget=DEFAULT_WRITE_BUFFER_SIZE, fsync=DEFAULT_FSYNC_POLICY):
+        """
+        Constructor method. `budget` is in bytes; see `FSYNC_POLICIES` for `fsync`.
+        """
+        self.budget = max(0, int(budget))
+        self.fsync = fsync if fsync in FSYNC_POLICIES else DEFAULT_FSYNC_POLICY
+        self.used = 0
+        self.writers = {}
+
+    def add(self, writer, offset: int, data, on_written=None):
+        """
+        Class method. Holds `data` for `writer` at `offset`, flushing if the budget is exceeded.
+        """
+        writer.pending[offset] = (data, on_written)
+        writer.pending_bytes += len(data)
+        self.used += len(data)
+        self.writers[writer.path] = writer
+
+        if self.used > self.budget:
+            self.relieve()
+
+    def relieve(self):
+        """
+        Class method. Flushes the files with the most buffered data until half the budget is free.
+        """
+        for writer in sorted(
+            self.writers.values(), key=lambda w: w.pending_bytes, reverse=True
+        ):
+            if self.used <= self.budget // 2:
+                break
+            writer.flush()
+
+    def flushed(self, writer, size: int):
+        """
+        Class method. Called by a writer once `size` bytes of its buffered data are on disk.
+        """
+        self.used -= size
+        if not writer.pending:
+            self.writers.pop(writer.path, None)
+
+    def lookup(self, path, offset: int, size: int):
+        """
+        Class method. Returns the buffered data for `size` bytes at `offset` in `path`, or None if that range
+        isn't buffered.
+        """
+        writer = self.writers.get(Path(path))
+        if writer is None:
+            return None
+
+        return writer.buffered(offset, size)
+
+
+class FileWriter:
+    """
+    Class wrapping a file that is being downloaded. The file is opened once, preallocated to its
+    final size, and chunks are read and written with positional I/O instead of reopening the file.
+
+    The writer is reference counted: every chunk in flight holds a reference, and the file is closed
+    when the last one is released.
+
+    With a `WriteBuffer`, writes are held in memory and reach the disk when the buffer flushes them. Callers
+    that need to know when data is actually written pass an `on_written` callback.
+    """
+
+    def __init__(self, path, size: int, on_close=None, buffer=None):
+        """
+        Constructor method. Opens (or creates) the file at `path` and sizes it to `size` bytes.
+        `on_close` is called with the writer once the file has been closed.
+        """
+        self.path = Path(path)
+        self.size = size
+        self.on_close = on_close
+        self.buffer = buffer
+        self.pending = {}
+        self.pending_bytes = 0
+        self.refs = 1
+        self.fd = os.open(
+            self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644
+        )
+        # Bytes that were on disk before preallocating; anything past them is zeros we put there
+        self.existing_size = min(os.fstat(self.fd).st_size, size)
+        self.preallocate()
+
+    def preallocate(self):
+        """
+        Class method. Makes the file on disk exactly `self.size` bytes long. Uses fallocate when the
+        platform has it so the blocks are reserved up front, and falls back to a sparse truncate.
+        """
+        current = os.fstat(self.fd).st_size
+        if current > self.size:
+            # Left over from an older version of the file; don't let it balloon.
+            os.ftruncate(self.fd, self.size)
+            return
+
+        if current == self.size:
+            return
+
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+                return
+            except OSError:
+                # Some filesystems (looking at you, FAT32) don't support it
+                pass
+
+        os.ftruncate(self.fd, self.size)
+
+    def existed(self, offset: int, size: int):
+        """
+        Class method. Returns True if the range was on disk before the writer opened the file, so it may
+        already hold the right data.
+        """
+        return offset + size <= self.existing_size
+
+    def read(self, offset: int, size: int):
+        """
+        Class method. Reads `size` bytes at `offset`.
+        """
+        data = self.buffered(offset, size)
+        if data is not None:
+            return data
+
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size, offset)
+
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.read(self.fd, size)
+
+    def buffered(self, offset: int, size: int):
+        """
+        Class method. Returns `size` bytes at `offset` if they are waiting in the write buffer, otherwise None.
+        """
+        entry = self.pending.get(offset)
+        if entry is None or len(entry[0]) < size:
+            return None
+
+        return bytes(entry[0][:size])
+
+    def write(self, offset: int, data, on_written=None):
+        """
+        Class method. Writes `data` at `offset`, or hands it to the write buffer. `on_written` is called once
+        the data is on disk.
+        """
+        if self.buffer is not None and self.buffer.budget > 0:
+            self.buffer.add(self, offset, data, on_written)
+            return
+
+        self.write_now(offset, data)
+        if on_written is not None:
+            on_written()
+
+    def write_now(self, offset: int, data):
+        """
+        Class method. Writes `data` at `offset` straight away.
+        """
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(self.fd, data, offset)
+        else:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            written = os.write(self.fd, data)
+
+        # Short writes are rare for regular files, but not impossible
+        view = memoryview(data)
+        while written < len(view):
+            view = view[written:]
+            offset += written
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                written = os.write(self.fd, view)
+
+    def write_vector(self, offset: int, buffers):
+        """
+        Class method. Writes consecutive `buffers` starting at `offset`, in one system call where possible.
+        """
+        if not hasattr(os, "pwritev"):
+            self.write_now(offset, b"".join(buffers))
+            return
+
+        for start in range(0, len(buffers), MAX_IOV):
+            batch = buffers[start : start + MAX_IOV]
+            total = sum(len(b) for b in batch)
+            written = os.pwritev(self.fd, batch, offset)
+            if written < total:
+                self.write_now(offset + written, b"".join(batch)[written:])
+            offset += total
+
+    def flush(self):
+        """
+        Class method. Writes out the buffered data, sorted by offset with adjacent ranges merged into one write.
+        """
+        if not self.pending:
+            return
+
+        start = time.perf_counter()
+        pending = sorted(self.pending.items())
+        self.pending = {}
+        size, self.pending_bytes = self.pending_bytes, 0
+
+        try:
+            run_start = None
+            run = []
+            run_end = None
+            for offset, (data, _) in pending:
+                if run and offset != run_end:
+                    self.write_vector(run_start, run)
+                    run = []
+                if not run:
+                    run_start = offset
+                    run_end = offset
+                run.append(data)
+                run_end += len(data)
+            self.write_vector(run_start, run)
+        finally:
+            # Before the fsync yields, so a write error or a kill there can't leave the budget used up for good
+            self.buffer.flushed(self, size)
+
+        if self.buffer.fsync == "flush":
+            self.fsync()
+
+        metrics.write_flush_seconds.observe(time.perf_counter() - start)
+        for _, (_, on_written) in pending:
+            if on_written is not None:
+                on_written()
+
+    def fsync(self):
+        """
+        Class method. Waits for the file's data to reach the disk, without blocking the other greenlets.
+        """
+        get_hub().threadpool.apply(os.fsync, (self.fd,))
+
+    def copy_from(
+        self, src_path, src_offset: int, offset: int, size: int, on_written=None, sha=None
+    ):
+        """
+        Class method. Copies `size` bytes at `src_offset` in another file (or this one) to `offset`.
+        Uses copy_file_range so the data never leaves the kernel when the platform supports it.
+        Ranges still in the write buffer are copied from there.
+
+        Returns False if the source is too short, or if the copied bytes don't hash to `sha` (a sha1 digest)
+        when it is given. `on_written` is only called for a good copy, so a damaged source is never vouched for.
+        """
+        if self.buffer is not None:
+            data = self.buffer.lookup(src_path, src_offset, size)
+            if data is not None:
+                if sha is not None and hashlib.sha1(data).digest() != sha:
+                    return False
+
+                self.write(offset, data, on_written)
+                return True
+
+        src_fd = os.open(src_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    done = 0
+                    while done < size:
+                        copied = os.copy_file_range(
+                            src_fd, self.fd, size - done, src_offset + done, offset + done
+                        )
+                        if copied == 0:
+                            # The source ends before the range does
+                            return False
+                        done += copied
+
+                    # The data never passed through here, so check what landed
+                    if sha is not None and (
+                        hashlib.sha1(os.pread(self.fd, size, offset)).digest() != sha
+                    ):
+                        return False
+
+                    if on_written is not None:
+                        on_written()
+                    return True
+                except OSError:
+                    # Not every filesystem pair supports it (cross-device before Linux 5.3, FUSE, ...)
+                    pass
+
+            if hasattr(os, "pread"):
+                data = os.pread(src_fd, size, src_offset)
+            else:
+                os.lseek(src_fd, src_offset, os.SEEK_SET)
+                data = os.read(src_fd, size)
+        finally:
+            os.close(src_fd)
+
+        if len(data) < size or (sha is not None and hashlib.sha1(data).digest() != sha):
+            return False
+
+        self.write(offset, data, on_written)
+        return True
+
+    def acquire(self):
+        """
+        Class method. Takes a reference on the writer.
+        """
+        self.refs += 1
+
+    def release(self):
+        """
+        Class method. Drops a reference on the writer, closing the file when nothing holds it anymore.
+        """
+        self.refs -= 1
+        if self.refs <= 0:
+            self.close()
+
+    def close(self):
+        """
+        Class method. Flushes and closes the file. Safe to call more than once.
+        """
+        if self.fd is None:
+            return
+
+        if self.buffer is not None:
+            self.flush()
+            if self.buffer.fsync != "never":
+                self.fsync()
+
+        os.close(self.fd)
+        self.fd = None
+
+        if self.on_close is not None:
+            self.on_close(self)
+
+    @property
+    def closed(self):
+        return self.fd is None